@@ -0,0 +1,41 @@
+"""Per-message cost of the blacklist check.
+
+Compares a string-keyed set, which needs ``str(id)`` on every lookup to
+match at all, with the integer-keyed :class:`utils.blacklist.Blacklist`.
+
+    $ python benchmarks/blacklist.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oneki"))
+
+from utils.blacklist import Blacklist  # noqa: E402
+
+
+NUMBER = 500_000
+
+
+def snowflake():
+    return random.randint(10 ** 17, 10 ** 19)
+
+
+def main():
+    print(f"{'entries':>8} {'str keys':>10} {'int index':>10} {'speedup':>8}")
+    for size in (10, 1_000, 100_000):
+        users = [snowflake() for _ in range(size)]
+        guilds = [snowflake() for _ in range(size // 10 + 1)]
+        str_users, str_guilds = {str(i) for i in users}, {str(i) for i in guilds}
+        index = Blacklist(users=users, guilds=guilds)
+
+        # the common case, an author that is not blacklisted
+        user_id, guild_id = snowflake(), snowflake()
+        old = timeit.timeit(lambda: str(user_id) in str_users or str(guild_id) in str_guilds, number=NUMBER)
+        new = timeit.timeit(lambda: index.is_blacklisted(user_id, guild_id), number=NUMBER)
+        print(f"{size:>8} {old / NUMBER * 1e9:>7.0f} ns {new / NUMBER * 1e9:>7.0f} ns {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Memory and presence-update cost of the full and lean cache profiles.
+
+Feeds synthetic GUILD_CREATE and PRESENCE_UPDATE payloads to a discord.py
+ConnectionState configured like the bot for each profile of
+:mod:`utils.cache_profiles`. No connection to discord is made.
+
+    $ python benchmarks/cache_profiles.py
+"""
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oneki"))
+
+from discord.state import ConnectionState  # noqa: E402
+from utils import cache_profiles  # noqa: E402
+
+
+GUILDS = 5
+MEMBERS_PER_GUILD = 20_000
+ONLINE_RATIO = 0.3
+VOICE_RATIO = 0.01
+PRESENCE_UPDATES = 50_000
+
+
+def user_payload(user_id):
+    return {"id": str(user_id), "username": f"user{user_id}", "discriminator": "0", "avatar": None}
+
+
+def presence_payload(guild_id, user_id):
+    return {
+        "user": {"id": str(user_id)},
+        "guild_id": str(guild_id),
+        "status": random.choice(("online", "idle", "dnd")),
+        "client_status": {"desktop": "online"},
+        "activities": [{"name": random.choice(("Minecraft", "Spotify", "Visual Studio Code")), "type": 0}],
+    }
+
+
+def guild_payload(guild_id):
+    roles = [{"id": str(guild_id), "name": "@everyone", "permissions": "0", "position": 0}]
+    roles.extend({"id": str(guild_id + i), "name": f"role{i}", "permissions": "0", "position": i} for i in range(1, 20))
+    members, presences, voice_states = [], [], []
+    for i in range(MEMBERS_PER_GUILD):
+        user_id = guild_id * 100_000 + i
+        members.append({
+            "user": user_payload(user_id),
+            "roles": [str(guild_id + random.randint(1, 19))],
+            "joined_at": "2022-01-01T00:00:00+00:00",
+            "deaf": False,
+            "mute": False,
+            "flags": 0,
+        })
+        if random.random() < ONLINE_RATIO:
+            presences.append(presence_payload(guild_id, user_id))
+        if random.random() < VOICE_RATIO:
+            voice_states.append({"user_id": str(user_id), "channel_id": str(guild_id + 1000), "session_id": "s",
+                                 "deaf": False, "mute": False, "self_deaf": False, "self_mute": False,
+                                 "self_video": False, "suppress": False, "request_to_speak_timestamp": None})
+
+    return {
+        "id": str(guild_id), "name": f"guild{guild_id}", "owner_id": "1", "roles": roles, "emojis": [],
+        "features": [], "member_count": MEMBERS_PER_GUILD, "large": True, "members": members,
+        "presences": presences, "voice_states": voice_states,
+        "channels": [{"id": str(guild_id + 1000), "type": 2, "name": "voice", "position": 0,
+                      "bitrate": 64000, "user_limit": 0}],
+    }
+
+
+def run(profile, guilds):
+    options = cache_profiles.get_cache_options(profile)
+    gc.collect()
+    tracemalloc.start()
+    state = ConnectionState(dispatch=lambda *args: None, handlers={}, hooks={}, http=None, **options)
+    for data in guilds:
+        state._add_guild_from_data(data)
+
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    updates = [presence_payload(int(g["id"]), int(g["id"]) * 100_000 + random.randrange(MEMBERS_PER_GUILD))
+               for g in random.choices(guilds, k=PRESENCE_UPDATES)]
+    start = time.perf_counter()
+    for data in updates:
+        state.parse_presence_update(data)
+
+    elapsed = time.perf_counter() - start
+    members = sum(len(guild._members) for guild in state.guilds)
+    return members, memory, elapsed
+
+
+def main():
+    random.seed(0)
+    guilds = [guild_payload(10 ** 6 + i * 10 ** 3) for i in range(GUILDS)]
+    print(f"{GUILDS} guilds x {MEMBERS_PER_GUILD} members, {PRESENCE_UPDATES} presence updates")
+    print(f"{'profile':>8} {'cached members':>15} {'memory':>10} {'presence updates':>17}")
+    for profile in (cache_profiles.FULL, cache_profiles.LEAN):
+        members, memory, elapsed = run(profile, guilds)
+        print(f"{profile:>8} {members:>15} {memory / 2 ** 20:>7.1f} MiB {elapsed / PRESENCE_UPDATES * 1e6:>11.2f} us/op")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Per-message cost of evaluating a counting channel message.
+
+Compares the ``int(eval(...))`` that ``Counting.on_message`` used to run on
+every message with :func:`utils.arithmetic.evaluate`, uncached (first time a
+message is seen) and cached. The last rows are messages that the old path
+could not survive, they are only timed with the new one.
+
+    $ python benchmarks/counting_eval.py
+"""
+import cmath
+import math
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oneki"))
+
+from utils import arithmetic  # noqa: E402
+
+
+NUMBER = 20_000
+MESSAGES = {
+    "number": "1234",
+    "sum": "1200 + 34",
+    "power": "2^10 + 210",
+    "factorial": "factorial(7) - 3806",
+    "math": "math.floor(math.sqrt(1522756))",
+}
+MALICIOUS = {
+    "tower": "9^9^9",
+    "factorial": "factorial(10**6)",
+    "long": "+".join(["99"] * 500),
+}
+
+
+def old_eval(content):
+    # what on_message did for every message
+    content = content.replace("^", "**")
+    return int(eval(content, {
+        "pow": math.pow,
+        "factorial": math.factorial,
+        "sqrt": math.sqrt,
+        "math": math,
+        "cmath": cmath,
+        "print": lambda *_: None,
+    }, {}))
+
+
+def uncached(content):
+    try:
+        return arithmetic._evaluate(content)
+    except arithmetic.ExpressionError:
+        pass
+
+
+def cached(content):
+    try:
+        return arithmetic.evaluate(content)
+    except arithmetic.ExpressionError:
+        pass
+
+
+def main():
+    print(f"{'message':>10} {'eval':>10} {'uncached':>10} {'cached':>10} {'speedup':>8}")
+    for kind, content in MESSAGES.items():
+        assert old_eval(content) == arithmetic.evaluate(content)
+        old = timeit.timeit(lambda: old_eval(content), number=NUMBER)
+        new = timeit.timeit(lambda: uncached(content), number=NUMBER)
+        hit = timeit.timeit(lambda: cached(content), number=NUMBER)
+        old_ns, new_ns, hit_ns = (t / NUMBER * 1e9 for t in (old, new, hit))
+        print(f"{kind:>10} {old_ns:>7.0f} ns {new_ns:>7.0f} ns {hit_ns:>7.0f} ns {old / new:>7.1f}x")
+
+    for kind, content in MALICIOUS.items():
+        new = timeit.timeit(lambda: uncached(content), number=NUMBER)
+        print(f"{kind:>10} {'-':>10} {new / NUMBER * 1e9:>7.0f} ns {'-':>10} {'-':>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Per-message cost of resolving the command prefix.
+
+Compares the list that ``_prefix_callable`` used to build for every message
+(then scanned by discord.py the way ``get_context`` does) with a precompiled
+:class:`utils.prefix.PrefixMatcher`.
+
+    $ python benchmarks/prefix_matcher.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "oneki"))
+
+from utils.prefix import PrefixMatcher  # noqa: E402
+
+
+USER_ID = 885674115946643456
+NUMBER = 200_000
+MESSAGES = {
+    "chat": "hola a todos, alguien juega hoy?",
+    "command": "!!help counting",
+}
+
+
+def build_prefixes(count):
+    prefixes = ["!!"]
+    prefixes.extend(f"p{i}." for i in range(count - 1))
+    return prefixes
+
+
+def per_message_list(prefixes, content):
+    # what _prefix_callable + get_context did for every message
+    base = [f"<@!{USER_ID}> ", f"<@{USER_ID}> "]
+    base.extend(prefixes)
+    if content.startswith(tuple(base)):
+        for prefix in base:
+            if content.startswith(prefix):
+                return prefix
+
+
+def main():
+    mentions = (f"<@!{USER_ID}> ", f"<@{USER_ID}> ")
+    print(f"{'prefixes':>8} {'message':>8} {'per-message list':>18} {'matcher':>10} {'speedup':>8}")
+    for count in (1, 2, 5, 10, 20):
+        prefixes = build_prefixes(count)
+        matcher = PrefixMatcher((*mentions, *prefixes))
+        for kind, content in MESSAGES.items():
+            old = timeit.timeit(lambda: per_message_list(prefixes, content), number=NUMBER)
+            new = timeit.timeit(lambda: matcher.match(content), number=NUMBER)
+            old_ns, new_ns = old / NUMBER * 1e9, new / NUMBER * 1e9
+            print(f"{count:>8} {kind:>8} {old_ns:>15.0f} ns {new_ns:>7.0f} ns {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
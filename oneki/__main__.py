@@ -1,6 +1,17 @@
-from bot import OnekiBot
+from utils.timeline import timeline
 
-if __name__ == '__main__':
-    bot = OnekiBot()
-    bot.run()
+with timeline.step("import bot"):
+    from bot import OnekiBot
+
+from utils import env
+from launcher import launch
+
+import asyncio
 
+
+if __name__ == '__main__':
+    if env.SHARD_COUNT is None:
+        bot = OnekiBot()
+        bot.run()
+    else:
+        asyncio.run(launch(int(env.SHARD_COUNT), int(env.SHARD_PROCESSES or 1)))
@@ -1,13 +1,21 @@
 import traceback
+import asyncio
 import aiohttp
+import signal
 import sys
 
+from collections import Counter
+
 import utils
-from utils import translations, context, db, env, ui
+from utils import translations, context, db, env, ui, config, blacklist, ipc, cache_profiles, snapshot, outbox, accumulator, scheduler
+from utils.prefix import PrefixMatcher
+from utils.timeline import timeline
+from utils.accounting import accounting, REPORT_INTERVAL
+from utils.snapshot import StateSnapshot
 from command_tree import CommandTree
-from typing import Union
+from typing import Any, Optional, Union
 
-from cogs import initial_extensions
+from cogs import initial_extensions, dev_extensions, dependencies
 
 
 description = """
@@ -16,42 +24,60 @@ Hola!, soy Oneki un bot multitareas y estare muy feliz en ayudarte en los que ne
 
 
 def _prefix_callable(bot, msg: utils.discord.Message):
-    user_id = bot.user.id
-    base = [f"<@!{user_id}> ", f"<@{user_id}> "]
-    if msg.guild is None:
-        base.append('?')
-        base.append('>')
-    else:
-        base.extend(bot.get_raw_guild_prefixes(msg.guild.id))
-    
-    return base
+    return list(bot.get_prefix_matcher(msg.guild and msg.guild.id).prefixes)
 
 
 class OnekiBot(utils.commands.Bot):
     version: str = "0.17a"
     
-    def __init__(self):
+    def __init__(self, *, worker_id: int = 0, **options):
         allowed_mentions = utils.discord.AllowedMentions(roles=False, everyone=False, users=True)
-        intents = utils.discord.Intents(
-            guilds=True,
-            members=True,
-            presences=True,
-            voice_states=True,
-            messages=True,
-            message_content=True,
-            bans=True
-        )
+        self.cache_profile = env.CACHE_PROFILE or cache_profiles.FULL
         
         super().__init__(
             command_prefix=_prefix_callable,
             description=description,
             allowed_mentions=allowed_mentions,
-            intents=intents,
             case_insensitive=True,
-            tree_cls=CommandTree
+            tree_cls=CommandTree,
+            **cache_profiles.get_cache_options(self.cache_profile),
+            **options
         )
         
+        # sharded mode runs one bot per process, they talk through self.ipc
+        self.worker_id = worker_id
+        self.ipc: Optional[ipc.Client] = None
+        # worker_id: guild count of the other workers
+        self.guild_counts: dict[int, int] = {}
+        
+        # filled in setup_hook, the bot user is only known after login
+        self.mentions: tuple[str, ...] = ()
+        self.mention_prefixes: tuple[str, ...] = ()
+        self.default_prefix_matcher = PrefixMatcher(config.DEFAULT_PREFIXES)
+        # exit taken by every message, counted by on_message and process_commands
+        self.message_exits: Counter[str] = Counter()
+        
         self.db = db.async_client()
+        self.snapshot_path = env.SNAPSHOT_PATH or snapshot.DEFAULT_PATH
+        if worker_id:
+            # the workers of the sharded mode hold different guilds
+            self.snapshot_path = f"{self.snapshot_path}.{worker_id}"
+        # fresh sections of the snapshot, taken by whoever restores them
+        self.warm_state: dict[str, tuple[Any, dict]] = {}
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._accounting_task: Optional[asyncio.Task] = None
+        self._close_task: Optional[asyncio.Task] = None
+        # created in setup_hook, close runs without them when the login failed
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.outbox: Optional[outbox.Outbox] = None
+        self.stats: Optional[accumulator.Accumulator] = None
+        self.scheduler: Optional[scheduler.Scheduler] = None
+        self.subscriptions: list[db.Subscription] = []
+        # cog name: state of the instance being reloaded, see reload_extension_with_state
+        self.handoffs: dict[str, utils.cog.Handoff] = {}
+        self.guild_configs = config.GuildConfigCache(
+            self.db, on_evict=lambda guild_id: self.dispatch("guild_config_evict", guild_id)
+        )
         self.debug_channel_id = env.DEBUG_CHANNEL
         self.bot_emojis = {
             "enojao": "<:enojao:989312639744233502>",
@@ -60,33 +86,32 @@ class OnekiBot(utils.commands.Bot):
             "disgustado": "<:perturbado:897292618692718622>"
         }
 
-    async def _get_guild_settings(self):
-        # guild_id: list
-        prefixes = {}
-        
-        collection_ref = self.db.collection("guilds")
-        async for doc_ref in collection_ref.list_documents():
-            doc = await doc_ref.get()
-            if doc.exists: 
-                data = doc.to_dict()
-                if data.get("prefixes") is not None:
-                    prefixes[doc.id] = data.get("prefixes")
-        
-        return prefixes
-
-    async def _get_blacklist(self):
-        # {users: {id, ...}, guilds: {id, ...}}
-        blacklist = {"users": set(), "guilds": set()}
+    async def _on_guilds_snapshot(self, docs, changes, initial):
+        # only guilds with a cached config care about remote prefix changes
+        for change in changes:
+            guild_config = self.guild_configs.peek(int(change.document.id))
+            if guild_config is None:
+                continue
 
-        guilds_doc = await self.db.document("blacklist/guilds").get()
-        if guilds_doc.exists:
-            blacklist["guilds"] = set(guilds_doc.to_dict().keys())
-            
-        users_doc = await self.db.document("blacklist/users").get()
-        if users_doc.exists:
-            blacklist["users"] = set(users_doc.to_dict().keys())
-        
-        return blacklist
+            if change.type == self.db.ChangeType.REMOVED:
+                guild_config.prefixes = config.DEFAULT_PREFIXES.copy()
+            else:
+                data = change.document.to_dict()
+                guild_config.prefixes = data.get("prefixes") or config.DEFAULT_PREFIXES.copy()
+
+    async def _on_blacklist_snapshot(self, docs, changes, initial):
+        # only the documents written since the start, the initial snapshot patches too
+        for change in changes:
+            if change.document.id not in (blacklist.USERS, blacklist.GUILDS):
+                continue
+
+            path = change.document.reference.path
+            if change.type == self.db.ChangeType.REMOVED:
+                self.blacklist.replace(change.document.id, ())
+                self.blacklist.versions[path] = None
+            else:
+                self.blacklist.replace(change.document.id, blacklist.ids_of(change.document.to_dict()))
+                self.blacklist.versions[path] = db.version(change.document)
 
     def get_guild_prefixes(self, guild, *, local_inject=_prefix_callable):
         proxy_msg = utils.discord.Object(id=0)
@@ -94,73 +119,269 @@ class OnekiBot(utils.commands.Bot):
         return local_inject(self, proxy_msg)
 
     def get_raw_guild_prefixes(self, guild_id):
-        return self.prefixes.get(str(guild_id), ['?', '>'])
+        guild_config = self.guild_configs.peek(int(guild_id))
+        if guild_config is None:
+            return config.DEFAULT_PREFIXES
+        
+        return guild_config.prefixes
+
+    def get_prefix_matcher(self, guild_id) -> PrefixMatcher:
+        if guild_id is None:
+            return self.default_prefix_matcher
+        
+        guild_config = self.guild_configs.peek(int(guild_id))
+        if guild_config is None:
+            return self.default_prefix_matcher
+        
+        return guild_config.get_prefix_matcher(self.mention_prefixes)
+
+    async def get_prefix(self, message: utils.discord.Message):
+        # hand back only the matched prefix so get_context does not try every candidate again
+        prefix = self.get_prefix_matcher(message.guild and message.guild.id).match(message.content)
+        return prefix if prefix is not None else []
+
+    def owns_guild(self, guild_id: Optional[int]) -> bool:
+        """Whether this process handles ``guild_id``, None for work of no guild in particular"""
+        return True
+
+    async def get_guild_config(self, guild_id) -> config.GuildConfig:
+        return await self.guild_configs.get(int(guild_id))
+
+    async def fetch_presence(self, member: utils.discord.Member) -> utils.discord.Member:
+        """Returns ``member`` with its presence, queried when presences are not cached"""
+        if self.cache_profile != cache_profiles.LEAN:
+            return member
+        
+        members = await member.guild.query_members(user_ids=[member.id], presences=True, cache=False)
+        return members[0] if members else member
 
     def get_guild_lang(self, guild):
         return guild.preferred_locale.value.split("-")[0]
 
     async def add_to_blacklist(self, object: Union[utils.discord.User, utils.discord.Guild], *, reason=None):
-        doc_ref = self.db.document(f"blacklist/{'guilds' if isinstance(object, utils.discord.Guild) else 'users'}")
-        await doc_ref.set({str(object.id): reason})
-        
-        self.blacklist["guilds" if isinstance(object, utils.discord.Guild) else "users"].add(str(object.id))
+        kind = blacklist.GUILDS if isinstance(object, utils.discord.Guild) else blacklist.USERS
+        await self.blacklist.add_many(self.db, kind, {object.id: reason})
+        if self.ipc is not None:
+            self.ipc.publish("blacklist", {"kind": kind, "add": [object.id]})
 
     async def remove_from_blacklist(self, object: Union[utils.discord.User, utils.discord.Guild]):
-        doc_ref = self.db.document(f"blacklist/{'guilds' if isinstance(object, utils.discord.Guild) else 'users'}")
-        blacklist = self.blacklist['guilds' if isinstance(object, utils.discord.Guild) else 'users']
-        if not str(object.id) in blacklist:
+        if not self.in_blacklist(object):
             raise Exception(f"{object.id} not in blacklist")
 
-        await doc_ref.delete(str(object.id))
-        blacklist.remove(str(object.id))
+        kind = blacklist.GUILDS if isinstance(object, utils.discord.Guild) else blacklist.USERS
+        await self.blacklist.remove_many(self.db, kind, [object.id])
+        if self.ipc is not None:
+            self.ipc.publish("blacklist", {"kind": kind, "remove": [object.id]})
 
     def in_blacklist(self, object: Union[utils.discord.User, utils.discord.Guild]):
         if isinstance(object, utils.discord.Guild):
-            return True if object.id in self.blacklist["guilds"] else False
+            return object.id in self.blacklist.guilds
+        
+        return object.id in self.blacklist.users
+
+    async def _load_extension(self, ext) -> bool:
+        try:
+            with timeline.step(f"load {ext}"):
+                await self.load_extension(ext)
+        except Exception:
+            print(f"Failed to load extension {ext}.", file=sys.stderr)
+            traceback.print_exc()
+            return False
         
-        return True if object.id in self.blacklist["users"] else False
+        return True
 
     async def load_extensions(self, extensions):
-        for ext in extensions:
+        # load in waves, each one holds the extensions whose dependencies are loaded
+        pending = list(extensions)
+        loaded = set(self.extensions)
+        while pending:
+            wave = [ext for ext in pending if all(dep in loaded for dep in dependencies.get(ext, []))]
+            if not wave:
+                for ext in pending:
+                    print(f"Failed to load extension {ext}, missing dependencies.", file=sys.stderr)
+                
+                return
+            
+            results = await asyncio.gather(*(self._load_extension(ext) for ext in wave))
+            loaded.update(ext for ext, ok in zip(wave, results) if ok)
+            pending = [ext for ext in pending if ext not in wave]
+
+    async def reload_extension_with_state(self, name: str):
+        """Reloads an extension handing the state of its cogs to the new instances"""
+        handoffs = {
+            cog.qualified_name: cog.handoff()
+            for cog in self.cogs.values() if isinstance(cog, utils.Cog) and cog.__module__ == name
+        }
+        
+        self.handoffs.update(handoffs)
+        try:
+            await self.reload_extension(name)
+        finally:
+            for cog_name, handoff in handoffs.items():
+                self.handoffs.pop(cog_name, None)
+                handoff.close()
+
+    async def reload_translations(self):
+        # a single assignment, readers see either the old or the new translations
+        self.translations = await asyncio.to_thread(translations.Translations.load)
+
+    async def reload(self, target: str, *, publish: bool = True):
+        """Reloads ``translations`` or an extension, on every worker if ``publish``"""
+        if target == "translations":
+            await self.reload_translations()
+        else:
+            await self.reload_extension_with_state(target)
+        
+        if publish and self.ipc is not None:
+            self.ipc.publish("reload", target)
+
+    async def _load_snapshot(self):
+        state_snapshot = StateSnapshot.load(self.snapshot_path)
+        if state_snapshot is None:
+            return
+        
+        self.warm_state = await state_snapshot.validate(self.db)
+        print(f"[+] Snapshot: {len(self.warm_state)}/{len(state_snapshot.sections)} sections unchanged")
+        
+        for name in [name for name in self.warm_state if name.startswith("guild_config/")]:
+            state, versions = self.warm_state.pop(name)
+            self.guild_configs.put(config.GuildConfig.from_state(state, versions))
+
+    def write_snapshot(self):
+        state_snapshot = StateSnapshot()
+        state_snapshot.add("blacklist", self.blacklist.to_state(), self.blacklist.versions)
+        for guild_config in self.guild_configs.values():
+            state_snapshot.add(f"guild_config/{guild_config.guild_id}", guild_config.to_state(), guild_config.versions)
+        
+        for cog in self.cogs.values():
+            data = cog.snapshot() if isinstance(cog, utils.Cog) else None
+            if data is not None:
+                state_snapshot.add(f"cog/{cog.qualified_name}", *data)
+        
+        state_snapshot.dump(self.snapshot_path)
+
+    async def _snapshot_loop(self):
+        while not self.is_closed():
+            await asyncio.sleep(snapshot.INTERVAL)
             try:
-                await self.load_extension(ext)
-            except Exception as e:
-                print(f"Failed to load extension {ext}.", file=sys.stderr)
+                self.write_snapshot()
+            except Exception:
+                print("Failed to write the snapshot.", file=sys.stderr)
                 traceback.print_exc()
 
+    async def _accounting_loop(self):
+        while not self.is_closed():
+            await asyncio.sleep(REPORT_INTERVAL)
+            print(f"[+] Firestore operations:\n{accounting.report(limit=20)}")
+
     async def setup_hook(self) -> None:
+        self.mentions = (f"<@!{self.user.id}>", f"<@{self.user.id}>")
+        self.mention_prefixes = tuple(f"{mention} " for mention in self.mentions)
+        self.default_prefix_matcher = PrefixMatcher((*self.mention_prefixes, *config.DEFAULT_PREFIXES))
+        # documents are read on demand from now on, listeners only see what changes after
+        self.listen_since = utils.utcnow() - utils.datetime.timedelta(seconds=db.LISTEN_CLOCK_SKEW)
+        
         self.session = aiohttp.ClientSession(
             loop=self.loop,
             headers={"User-Agent": f"OnekiBot/{self.version} (+https://github.com/OnekiDevs/oneki-py)"}
         )
         
-        # prefixes[guild_id]: list
-        self.prefixes = await self._get_guild_settings()
-
-        # user_id mapped to True
-        # these are users globally blacklisted
-        self.blacklist = await self._get_blacklist()
+        # writes that must not wait on firestore, one file per worker
+        outbox_path = env.OUTBOX_PATH or outbox.DEFAULT_PATH
+        if self.worker_id:
+            outbox_path = f"{outbox_path}.{self.worker_id}"
         
-        if self.debug_channel_id is not None:
-            self.debug_channel = await self.fetch_channel(int(self.debug_channel_id))
+        self.outbox = outbox.Outbox(self.db, outbox_path)
+        self.outbox.start()
+        
+        # counters incremented on every message, written behind through the outbox
+        self.stats = accumulator.Accumulator(self.outbox)
+        self.stats.start()
+        
+        # delayed jobs the cogs register handlers for, each run by the worker of its guild
+        self.scheduler = scheduler.Scheduler(self.db, self.outbox, owns=self.owns_guild)
+        self.scheduler.start()
+        
+        with timeline.step("load snapshot"):
+            await self._load_snapshot()
+        
+        async def fetch_blacklist():
+            # users and guilds globally blacklisted
+            warm = self.warm_state.pop("blacklist", None)
+            if warm is not None:
+                self.blacklist = blacklist.Blacklist.from_state(*warm)
+                return
             
-        self.translations = translations.Translations.load()
+            with timeline.step("fetch blacklist"):
+                self.blacklist = await blacklist.Blacklist.fetch(self.db)
+        
+        async def fetch_debug_channel():
+            if self.debug_channel_id is not None:
+                with timeline.step("fetch debug channel"):
+                    self.debug_channel = await self.fetch_channel(int(self.debug_channel_id))
+        
+        await asyncio.gather(fetch_blacklist(), fetch_debug_channel())
+
+        # keep the caches above in sync with changes made outside this process, without reading them again
+        with timeline.step("subscribe"):
+            self.subscriptions = [
+                self.db.subscribe("guilds", self._on_guilds_snapshot, since=self.listen_since),
+                self.db.subscribe("blacklist", self._on_blacklist_snapshot, since=self.listen_since)
+            ]
+        
+        with timeline.step("load translations"):
+            self.translations = translations.Translations.load()
         
         # cogs unload
-        await self.load_extensions(initial_extensions)
+        with timeline.step("load extensions"):
+            await self.load_extensions(initial_extensions + dev_extensions)
         
-        # sync
-        await self.tree.sync()
-                
-    async def on_ready(self):
-        activity = utils.discord.Activity(type=utils.discord.ActivityType.watching, name=f"{len(self.guilds)} servidores")
+        # sync, the command tree is global so one worker is enough
+        if self.worker_id == 0:
+            with timeline.step("sync command tree"):
+                synced = await self.tree.sync_if_changed(self.db, force=bool(env.FORCE_SYNC))
+            
+            print("[+] Command tree synced" if synced else "[+] Command tree unchanged, sync skipped")
+        
+        self._snapshot_task = asyncio.create_task(self._snapshot_loop())
+        self._accounting_task = asyncio.create_task(self._accounting_loop())
+        print(f"[+] Startup timeline:\n{timeline.report()}")
+
+    async def update_presence(self):
+        guild_count = len(self.guilds) + sum(self.guild_counts.values())
+        activity = utils.discord.Activity(type=utils.discord.ActivityType.watching, name=f"{guild_count} servidores")
         await self.change_presence(
             status=utils.discord.Status.idle, 
             activity=activity
         )
+                
+    async def on_ready(self):
+        await self.update_presence()
+        if self.ipc is not None:
+            self.ipc.publish("guild_count", len(self.guilds))
 
         print(f"[+] Ready: {self.user} (ID: {self.user.id})")
 
+    async def on_ipc_guild_count(self, count: int, worker_id: int):
+        # answer workers we have not heard of yet, they started after our on_ready
+        if worker_id not in self.guild_counts and self.is_ready():
+            self.ipc.publish("guild_count", len(self.guilds))
+        
+        self.guild_counts[worker_id] = count
+        if self.is_ready():
+            await self.update_presence()
+
+    async def on_ipc_blacklist(self, data: dict, worker_id: int):
+        self.blacklist.add(data["kind"], data.get("add", ()))
+        self.blacklist.discard(data["kind"], data.get("remove", ()))
+
+    async def on_ipc_reload(self, target: str, worker_id: int):
+        try:
+            await self.reload(target, publish=False)
+        except Exception:
+            print(f"Failed to reload {target}.", file=sys.stderr)
+            traceback.print_exc()
+
     async def on_command_error(self, ctx: context.Context, error: utils.commands.CommandError):
         translation = self.translations.event(ctx.lang, "command_error")
         err = getattr(error, "original", error)
@@ -171,6 +392,8 @@ class OnekiBot(utils.commands.Bot):
             await ctx.send(translation.no_private_message)
         elif isinstance(err, utils.commands.DisabledCommand):
             await ctx.send(translation.disabled_command)
+        elif db.is_unavailable(err):
+            await ctx.send(translation.unavailable)
         elif not isinstance(err, (utils.discord.HTTPException, utils.commands.CheckFailure)):                
             view = ui.ReportBug(error=err)
             await view.start(ctx)
@@ -190,22 +413,39 @@ class OnekiBot(utils.commands.Bot):
         return await super().get_context(origin, cls=cls)
 
     async def process_commands(self, message: utils.discord.Message):
-        ctx = await self.get_context(message)
-
+        # reject before building a Context, most messages are not commands
         if message.author.bot:
+            self.message_exits["bot"] += 1
+            return
+
+        if self.blacklist.is_blacklisted(message.author.id, message.guild and message.guild.id):
+            self.message_exits["blacklisted"] += 1
             return
 
-        if self.in_blacklist(ctx.author) or self.in_blacklist(ctx.guild):
+        if self.get_prefix_matcher(message.guild and message.guild.id).match(message.content) is None:
+            self.message_exits["no_prefix"] += 1
             return
 
+        ctx = await self.get_context(message)
+        self.message_exits["invoked"] += 1
         await self.invoke(ctx)
 
     async def on_message(self, message: utils.discord.Message):
         if message.author.bot:
+            self.message_exits["bot"] += 1
+            return
+
+        # rejected before loading the guild config, that may cost a read
+        if self.blacklist.is_blacklisted(message.author.id, message.guild and message.guild.id):
+            self.message_exits["blacklisted"] += 1
             return
 
+        # prefixes are read synchronously by _prefix_callable
+        if message.guild is not None:
+            await self.get_guild_config(message.guild.id)
+
         # if the bot is mentioned
-        if message.content in [f'<@!{self.user.id}>', f'<@{self.user.id}>']:
+        if message.content in self.mentions:
             translation = self.translations.event(self.get_guild_lang(message.guild), "ping")
             prefixes = self.get_raw_guild_prefixes(message.guild.id)
             if len(prefixes) == 1:
@@ -216,11 +456,73 @@ class OnekiBot(utils.commands.Bot):
 
         await self.process_commands(message)
 
+    async def on_guild_remove(self, guild: utils.discord.Guild):
+        self.guild_configs.pop(guild.id)
+
     async def close(self):
+        # once, a SIGTERM, a command and the exit of run may all ask for it
+        if self._close_task is None:
+            self._close_task = asyncio.create_task(self._close())
+
+        await self._close_task
+
+    async def __aexit__(self, *args):
+        # the whole close, discord.py only waits for its own part
+        await self.close()
+
+    async def _close(self):
+        if self._accounting_task is not None:
+            self._accounting_task.cancel()
+        
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            try:
+                self.write_snapshot()
+            except Exception:
+                print("Failed to write the snapshot.", file=sys.stderr)
+                traceback.print_exc()
+        
+        for subscription in self.subscriptions:
+            subscription.close()
+        
         await super().close()
-        await self.session.close()
+        if self.stats is not None:
+            self.stats.close()
+        # the scheduler writes through the outbox
+        if self.scheduler is not None:
+            await self.scheduler.close()
+        if self.outbox is not None:
+            await self.outbox.close()
+        if self.session is not None:
+            await self.session.close()
+        if self.ipc is not None:
+            await self.ipc.close()
+        
         print("goodbye!")
 
+    async def start(self, token: str, *, reconnect: bool = True):
+        # heroku stops a dyno with SIGTERM, close saves the state and sends the pending writes
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(self.close()))
+        except NotImplementedError:
+            # windows
+            pass
+
+        await super().start(token, reconnect=reconnect)
+
     def run(self):
         token = env.DISCORD_DEV_TOKEN or env.DISCORD_TOKEN
         super().run(token, reconnect=True)
+
+
+class ShardedOnekiBot(OnekiBot, utils.commands.AutoShardedBot):
+    """OnekiBot running a range of shards in a worker process, started by launcher"""
+    async def setup_hook(self) -> None:
+        self.ipc = await ipc.connect(self.worker_id, self.dispatch, port=int(env.IPC_PORT or ipc.DEFAULT_PORT))
+        await super().setup_hook()
+
+    def owns_guild(self, guild_id: Optional[int]) -> bool:
+        if guild_id is None:
+            return self.worker_id == 0
+
+        return (guild_id >> 22) % self.shard_count in self.shard_ids
@@ -8,3 +8,6 @@ initial_extensions = [
 dev_extensions = [
     module.name for module in iter_modules(__path__, f"{__package__}.") if module.name.startswith("_")
 ]
+
+# extension: extensions that must be loaded before it, the others load concurrently
+dependencies: dict[str, list[str]] = {}
@@ -0,0 +1,54 @@
+import utils
+from utils.accounting import accounting
+from utils.context import Context
+
+import io
+
+
+class Dev(utils.Cog, command_attrs=dict(hidden=True)):
+    """Owner only commands, prefixed so they stay out of the command tree"""
+    async def cog_check(self, ctx: Context) -> bool:
+        return await self.bot.is_owner(ctx.author)
+
+    @utils.commands.command()
+    async def reload(self, ctx: Context, target: str):
+        """Reloads ``translations`` or a cog (``counting`` or ``cogs.counting``) keeping its state"""
+        if target != "translations" and not target.startswith("cogs."):
+            target = f"cogs.{target}"
+        
+        try:
+            await self.bot.reload(target)
+        except Exception as e:
+            await ctx.send(f"```{type(e).__name__}: {e}```")
+        else:
+            await ctx.send(f"Reloaded `{target}`")
+
+    @utils.commands.command()
+    async def firestore_stats(self, ctx: Context, reset: bool = False):
+        """Dumps the firestore operations of every call site since the last reset"""
+        db = self.bot.db
+        breaker = " ".join(f"{key}={value}" for key, value in db.breaker.stats().items())
+        report = f"{accounting.report()}\n\nbreaker: {breaker}\ncached documents: {len(db.cache)}"
+        if reset:
+            accounting.reset()
+        
+        if len(report) > 1900:
+            await ctx.send(file=utils.discord.File(io.BytesIO(report.encode()), filename="firestore_stats.txt"))
+        else:
+            await ctx.send(f"```\n{report}\n```")
+
+    @utils.commands.command()
+    async def migrate_countings(self, ctx: Context):
+        """Moves the per user stats of the counting documents to their subcollection"""
+        from cogs.counting import migrate_users
+        
+        async with ctx.typing():
+            guilds, users, skipped = await migrate_users(self.bot.db)
+        
+        await ctx.send(f"Migrated {users} users of {guilds} guilds")
+        if skipped:
+            await ctx.send(f"Skipped {len(skipped)} guilds that kept changing, run it again: {', '.join(skipped[:50])}")
+
+
+async def setup(bot):
+    await bot.add_cog(Dev(bot))
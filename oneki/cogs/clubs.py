@@ -1,11 +1,11 @@
 import utils
 from utils import ui, db
 from utils.ui import confirm
+from google.api_core import exceptions
 from typing import AsyncGenerator, Optional, Coroutine, TYPE_CHECKING
 
 import io
 import json
-import yaml
 import uuid
 from bot import OnekiBot
 
@@ -13,13 +13,66 @@ if TYPE_CHECKING:
     from utils.db import AsyncClient, AsyncDocumentReference
 
 
+# attribute of Club: field of its document, the ones Club.update writes when they change
+FIELDS = {
+    "channel_id": "channel",
+    "name": "name",
+    "description": "description",
+    "owner_id": "owner",
+    "is_public": "public",
+    "is_nsfw": "nsfw",
+    "banner_url": "banner"
+}
+# fields a club_settings import can change
+IMPORTABLE_FIELDS = ("name", "description", "public", "nsfw", "banner")
+# writes of Club.update before giving up on a document that keeps changing
+UPDATE_ATTEMPTS = 3
+
+
 class ClubError(utils.app_commands.CheckFailure):
     pass
 
 
+class ClubAuthView(db.Projection):
+    """Owner and moderators of a club, the fields the moderation commands check"""
+    __slots__ = ("channel_id", "owner_id", "mod_ids")
+    fields = ("channel", "owner", "mods")
+    
+    def __init__(self, doc) -> None:
+        super().__init__(doc)
+        data = doc.to_dict()
+        self.channel_id = int(data["channel"])
+        self.owner_id = int(data["owner"])
+        self.mod_ids = {int(mid) for mid in data.get("mods", [])}
+    
+    @classmethod
+    def of_channel(cls, db: "AsyncClient", guild_id: int, channel_id: int) -> AsyncGenerator["ClubAuthView", None]:
+        query = db.collection(f"guilds/{guild_id}/clubs").where("channel", "==", str(channel_id))
+        return cls.stream(query)
+    
+    def is_mod(self, user_id: int) -> bool:
+        return user_id in self.mod_ids or user_id == self.owner_id
+    
+    def can_moderate(self, user_id: int, member_id: int) -> bool:
+        # mods can not moderate each other, only the owner can
+        if member_id == self.owner_id:
+            return False
+        
+        return member_id not in self.mod_ids or user_id == self.owner_id
+
+
 class Club:
-    """Represents a club data model"""
+    """Represents a club data model
+
+    Changes to the attributes of :data:`FIELDS` are tracked, :meth:`update`
+    only writes those. Members, mods, bans and mutes are written right away
+    by their methods with array transforms.
+    """
     def __init__(self, *, guild: utils.discord.Guild) -> None:        
+        # attributes changed since the document was read
+        self._dirty: set[str] = set()
+        self.update_time = None
+        
         self.guild = guild
         self.doc_ref: Optional[AsyncDocumentReference] = None
         self.channel_id = None
@@ -37,18 +90,45 @@ class Club:
         self.bans: list[int] = {}
         self.mutes: dict[int, utils.discord.Member] = {}
     
+    def __setattr__(self, name: str, value) -> None:
+        if name in FIELDS and getattr(self, name, None) != value:
+            self._dirty.add(name)
+            
+        super().__setattr__(name, value)
+    
+    def _read_fields(self, data: dict):
+        # the attributes changed locally are kept
+        values = {
+            "channel_id": int(data["channel"]),
+            "name": data["name"],
+            "description": data["description"],
+            "owner_id": int(data["owner"]),
+            "is_public": data["public"],
+            "is_nsfw": data["nsfw"],
+            "banner_url": data.get("banner")
+        }
+        dirty = set(self._dirty)
+        for name, value in values.items():
+            if name not in dirty:
+                setattr(self, name, value)
+                
+        self._dirty = dirty
+    
     @classmethod
-    async def from_data(cls, data: dict, *, guild: utils.discord.Guild, doc_ref: db.AsyncDocumentReference):
+    async def from_data(
+        cls, 
+        data: dict, 
+        *, 
+        guild: utils.discord.Guild, 
+        doc_ref: db.AsyncDocumentReference, 
+        update_time=None
+    ):
         club = cls(guild=guild)
         
         club.doc_ref = doc_ref
-        club.channel_id = int(data["channel"])
-        club.name = data["name"]
-        club.description = data["description"]
-        club.owner_id = int(data["owner"])
-        club.is_public = data["public"]
-        club.is_nsfw = data["nsfw"]
-        club.banner_url = data.get("banner")
+        club._dirty.clear()
+        club._read_fields(data)
+        club.update_time = update_time
 
         for mid in data["members"]:
             member = await club._fetch_member(int(mid))
@@ -159,6 +239,9 @@ class Club:
         
         if self.channel_id is not None:
             payload["channel"] = self.channel_id
+            
+        if self.banner_url is not None:
+            payload["banner"] = self.banner_url
         
         if utils.is_empty(self.members):
             payload["members"] = [str(self.owner_id)]
@@ -181,8 +264,51 @@ class Club:
             
         return payload
         
-    def update(self) -> Coroutine:
-        return self.doc_ref.update(self.to_dict())
+    def _field_value(self, name: str):
+        value = getattr(self, name)
+        if name == "owner_id":
+            return str(value)
+        elif name == "banner_url" and value is None:
+            return db.firestore.firestore.DELETE_FIELD
+        
+        return value
+    
+    async def refresh(self):
+        """Reads the document again, keeping the attributes changed since the last read"""
+        doc = await self.doc_ref.get()
+        if not doc.exists:
+            raise ClubError("Club not found")
+        
+        self._read_fields(doc.to_dict())
+        self.update_time = doc.update_time
+        
+    async def update(self):
+        """Writes the attributes changed since the club was read
+        
+        The write requires the document to be unchanged since it was read, on
+        a conflict the club is read again and the changes written on top of
+        what the other writer left.
+        """
+        for attempt in range(UPDATE_ATTEMPTS):
+            if not self._dirty:
+                return
+            
+            data = {FIELDS[name]: self._field_value(name) for name in self._dirty}
+            option = None
+            if self.update_time is not None:
+                option = self.doc_ref._client.write_option(last_update_time=self.update_time)
+                
+            try:
+                result = await self.doc_ref.update(data, option=option)
+            except exceptions.FailedPrecondition:
+                if attempt + 1 == UPDATE_ATTEMPTS:
+                    raise
+                
+                await self.refresh()
+            else:
+                self.update_time = result.update_time
+                self._dirty.clear()
+                return
         
 
 class IsNsfw(ui.View):
@@ -235,17 +361,18 @@ class Questionnaire(ui.Modal, title="Questionnaire Club"):
 
     async def on_submit(self, interaction: utils.discord.Interaction):
         db: AsyncClient = interaction.client.db
+        config = await interaction.client.get_guild_config(interaction.guild_id)
+        if config.clubs.get("approval_channel") is None:
+            raise ClubError("Clubs are not configured in this server")
         
         doc_ref = db.document(f"guilds/{interaction.guild_id}/clubs/wait_approval")
-        doc = await doc_ref.get()
-        data = doc.to_dict()
         
         club = Club(guild=interaction.guild)
         club.name = self.name.value
         club.description = self.description.value
         club.owner_id = interaction.user.id
         
-        if data.get("nsfw_clubs_enabled"):
+        if config.clubs.get("nsfw_clubs_enabled"):
             view = IsNsfw()
             await view.start(interaction, ephemeral=True)
             
@@ -254,12 +381,9 @@ class Questionnaire(ui.Modal, title="Questionnaire Club"):
             await interaction.response.send_message(self.translations.sent.format(interaction.user.name), ephemeral=True)
         
         id_hex = uuid.uuid1().hex
-        if doc.exists:
-            await doc_ref.update({id_hex: club.to_dict()})
-        else:
-            await doc_ref.set({id_hex: club.to_dict()})
+        await doc_ref.set({id_hex: club.to_dict()}, merge=True)
         
-        channel = await interaction.client.fetch_channel(data["approval_channel"])
+        channel = await interaction.client.fetch_channel(config.clubs["approval_channel"])
         
         embed = club.get_embed()
         embed.add_field(name="ID:", value=f"```{id_hex}```", inline=False)
@@ -283,7 +407,7 @@ class Explorer(ui.CancellableView):
                 continue
             
             doc = await doc_ref.get()
-            club = await Club.from_data(doc.to_dict(), guild=guild, doc_ref=doc_ref)
+            club = await Club.from_data(doc.to_dict(), guild=guild, doc_ref=doc_ref, update_time=doc.update_time)
             if club.is_public: 
                 if member.id in club.bans:
                     continue
@@ -385,12 +509,8 @@ class Explorer(ui.CancellableView):
         
 def check_is_mod():
     async def predicate(interaction: utils.discord.Interaction) -> bool:
-        db = interaction.client.db
-        
-        docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("channel", "==", str(interaction.channel_id)).stream()
-        async for doc in docs: # should only be one
-            data = doc.to_dict()
-            return str(interaction.user.id) in data.get("mods", []) or str(interaction.user.id) == data["owner"]
+        async for club in ClubAuthView.of_channel(interaction.client.db, interaction.guild_id, interaction.channel_id): # should only be one
+            return club.is_mod(interaction.user.id)
     
     return utils.app_commands.check(predicate)
                         
@@ -416,9 +536,9 @@ async def your_clubs_autocomplete(
 ) -> list[utils.app_commands.Choice[str]]:
     db = interaction.client.db
     
-    docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("owner", "==", f"{interaction.user.id}").stream()
+    docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("owner", "==", f"{interaction.user.id}").select(["name"]).stream()
     return [
-        utils.app_commands.Choice(name=f"{doc.to_dict()['name']} / {doc.id}", value=f"{doc.id}")
+        utils.app_commands.Choice(name=f"{doc.get('name')} / {doc.id}", value=f"{doc.id}")
         async for doc in docs
     ]
 
@@ -435,7 +555,8 @@ class ClubSettings(utils.app_commands.Group, name="club_settings"):
             club = await Club.from_data(
                 doc.to_dict(), 
                 guild=interaction.guild, 
-                doc_ref=doc_ref
+                doc_ref=doc_ref,
+                update_time=doc.update_time
             )
             
             if interaction.user.id == club.owner.id:
@@ -451,7 +572,8 @@ class ClubSettings(utils.app_commands.Group, name="club_settings"):
     async def change_name(self, interaction: utils.discord.Interaction, club_id: str, new_name: str): 
         translation = interaction.client.translations.command(interaction.locale.value, "change_name")
         club = await self.get_club(interaction, club_id)
-        await club.doc_ref.update({"name": new_name})
+        club.name = new_name
+        await club.update()
         
         channel = club.channel
         await channel.edit(name=new_name)
@@ -465,7 +587,8 @@ class ClubSettings(utils.app_commands.Group, name="club_settings"):
     async def set_as_public(self, interaction: utils.discord.Interaction, club_id: str): 
         translation = interaction.client.translations.command(interaction.locale.value, "set_as_public")
         club = await self.get_club(interaction, club_id)
-        club.doc_ref.update({"public": True})
+        club.is_public = True
+        await club.update()
         
         await interaction.response.send_message(translation.success, ephemeral=True)
 
@@ -483,7 +606,7 @@ class ClubSettings(utils.app_commands.Group, name="club_settings"):
         await view.start(interaction, ephemeral=True)
         
         if view.value:
-            await club.doc_ref.update({"banner": url})
+            await club.update()
                 
     @utils.app_commands.command()
     @utils.app_commands.rename(club_id="club")
@@ -515,17 +638,21 @@ class ClubSettings(utils.app_commands.Group, name="club_settings"):
         translation = interaction.client.translations.command(interaction.locale.value, "import")
         club = await self.get_club(interaction, club_id)
         
-        data = club.to_dict()
         if file.content_type.startswith("application/json"):
-            j = json.loads(await file.read())
-            data.update(j)
+            data = json.loads(await file.read())
         elif file.filename.endswith((".yml", ".yaml")):
-            y = yaml.safe_load(await file.read())
-            data.update(y)
+            import yaml
+            
+            data = yaml.safe_load(await file.read())
         else:
             raise ClubError(translation.not_supported_file_extension)
         
-        await club.doc_ref.update(data)
+        # only the settings that differ are written
+        for name, field in FIELDS.items():
+            if field in IMPORTABLE_FIELDS and field in data:
+                setattr(club, name, data[field])
+        
+        await club.update()
         await interaction.response.send_message("Configuraciones cargadas correctamente", ephemeral=True)
              
     mod_group = utils.app_commands.Group(name="mod", description="...")
@@ -561,22 +688,19 @@ class ClubModerator(utils.app_commands.Group, name="club_moderator"):
     async def mute(self, interaction: utils.discord.Interaction, member: utils.discord.Member):
         translation = interaction.client.translations.command(interaction.locale.value, "cmute")
         db: AsyncClient = interaction.client.db
-        docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("channel", "==", str(interaction.channel_id)).stream()
         
-        async for doc in docs: 
-            club = await Club.from_data(doc.to_dict(), guild=interaction.guild, doc_ref=doc.reference)
-            if not member.id in club.mods or interaction.user.id == club.owner_id:
-                if not member.id == club.owner_id:
-                    await club.add_mute(member)
-                    
-                    channel = club.channel
-                    overwrites = {
-                        **channel.overwrites,
-                        member: utils.discord.PermissionOverwrite(send_messages=False, add_reactions=False),
-                    }
-                    
-                    await channel.edit(overwrites=overwrites)
-                    return await interaction.response.send_message(translation.success.format(member))
+        async for club in ClubAuthView.of_channel(db, interaction.guild_id, interaction.channel_id): 
+            if club.can_moderate(interaction.user.id, member.id):
+                interaction.client.outbox.update(club.reference.path, {"mutes": db.ArrayUnion([str(member.id)])})
+                
+                channel = interaction.guild.get_channel(club.channel_id)
+                overwrites = {
+                    **channel.overwrites,
+                    member: utils.discord.PermissionOverwrite(send_messages=False, add_reactions=False),
+                }
+                
+                await channel.edit(overwrites=overwrites)
+                return await interaction.response.send_message(translation.success.format(member))
             
             await interaction.response.send_message(translation.not_have_permissions, ephemeral=True)
             
@@ -585,11 +709,11 @@ class ClubModerator(utils.app_commands.Group, name="club_moderator"):
     async def unmute(self, interaction: utils.discord.Interaction, member: utils.discord.Member):
         translation = interaction.client.translations.command(interaction.locale.value, "cunmute")
         db: AsyncClient = interaction.client.db
-        docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("channel", "==", str(interaction.channel_id)).stream()
+        docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("channel", "==", str(interaction.channel_id)).select(["channel"]).stream()
         
         async for doc in docs: 
-            await doc.reference.update({"mutes": db.ArrayRemove([str(member.id)])})
-            channel = await interaction.client.fetch_channel(doc.to_dict()["channel"])
+            interaction.client.outbox.update(doc.reference.path, {"mutes": db.ArrayRemove([str(member.id)])})
+            channel = await interaction.client.fetch_channel(doc.get("channel"))
             overwrites = {
                 **channel.overwrites,
                 member: utils.discord.PermissionOverwrite(send_messages=True, add_reactions=False),
@@ -603,22 +727,22 @@ class ClubModerator(utils.app_commands.Group, name="club_moderator"):
     async def ban(self, interaction: utils.discord.Interaction, member: utils.discord.Member):
         translation = interaction.client.translations.command(interaction.locale.value, "cban")
         db: AsyncClient = interaction.client.db
-        docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("channel", "==", str(interaction.channel_id)).stream()
         
-        async for doc in docs: 
-            club = await Club.from_data(doc.to_dict(), guild=interaction.guild, doc_ref=doc.reference)
-            if not member.id in club.mods or interaction.user.id == club.owner_id:
-                if not member.id == club.owner_id:
-                    await club.add_ban(member)
-                    
-                    channel = club.channel
-                    overwrites = {
-                        **channel.overwrites,
-                        member: utils.discord.PermissionOverwrite(view_channel=False),
-                    }
-                    
-                    await channel.edit(overwrites=overwrites)
-                    return await interaction.response.send_message(translation.success.format(member))
+        async for club in ClubAuthView.of_channel(db, interaction.guild_id, interaction.channel_id): 
+            if club.can_moderate(interaction.user.id, member.id):
+                interaction.client.outbox.update(club.reference.path, {
+                    "bans": db.ArrayUnion([str(member.id)]),
+                    "members": db.ArrayRemove([str(member.id)])
+                })
+                
+                channel = interaction.guild.get_channel(club.channel_id)
+                overwrites = {
+                    **channel.overwrites,
+                    member: utils.discord.PermissionOverwrite(view_channel=False),
+                }
+                
+                await channel.edit(overwrites=overwrites)
+                return await interaction.response.send_message(translation.success.format(member))
             
             await interaction.response.send_message(translation.not_have_permissions, ephemeral=True)
             
@@ -627,10 +751,10 @@ class ClubModerator(utils.app_commands.Group, name="club_moderator"):
     async def unban(self, interaction: utils.discord.Interaction, member: utils.discord.Member):
         translation = interaction.client.translations.command(interaction.locale.value, "cunban")
         db: AsyncClient = interaction.client.db
-        docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("channel", "==", str(interaction.channel_id)).stream()
+        docs = db.collection(f"guilds/{interaction.guild_id}/clubs").where("channel", "==", str(interaction.channel_id)).select([]).stream()
         
         async for doc in docs: 
-            await doc.reference.update({"bans": db.ArrayRemove([str(member.id)])})
+            interaction.client.outbox.update(doc.reference.path, {"bans": db.ArrayRemove([str(member.id)])})
             await interaction.response.send_message(translation.success.format(member), ephemeral=True)
     
 
@@ -673,11 +797,10 @@ class Clubs(utils.Cog):
         if nsfw_clubs_enabled is not None and nsfw_clubs_enabled:
             data["nsfw_clubs_enabled"] = nsfw_clubs_enabled
 
-        doc = await doc_ref.get()
-        if doc.exists:
-            await doc_ref.update(data)
-        else:
-            await doc_ref.set(data)
+        await doc_ref.set(data, merge=True)
+        
+        config = await interaction.client.get_guild_config(interaction.guild_id)
+        await config.reload_clubs(db)
         
         await interaction.response.send_message(translation.success)
         
@@ -1,22 +1,41 @@
 import utils
-from utils import ui
+from utils import ui, arithmetic
 from utils.ui import confirm
 from utils.context import Context
-from typing import Optional, AsyncGenerator, TYPE_CHECKING
+from utils.serial import SerialQueues
+from utils.config import COUNTING_STATE, merge_counting_state
+from google.api_core import exceptions
+from functools import partial
+from typing import Optional, AsyncGenerator, Coroutine, TYPE_CHECKING
 
 import math
-import cmath
+import sys
+import traceback
 
 if TYPE_CHECKING:
-    from utils.db import firestore
+    from utils.db import firestore, AsyncClient
     DocumentSnapshot = firestore.firestore.DocumentSnapshot
 
 
+# messages of a counting channel waiting to be checked, the ones beyond are dropped
+QUEUE_SIZE = 100
+# seconds the fail role is kept, and the scheduler job that removes it
+FAIL_ROLE_DURATION = 43200.0
+FAIL_ROLE_JOB = "counting.remove_fail_role"
+# users moved per chunk by migrate_users, all of them are deleted from the guild document in one update
+MIGRATION_CHUNK = 500
+# seconds before reading again a guild document that changed while migrating it,
+# and chunks in a row that may fail that way before the guild is skipped
+MIGRATION_RETRY_DELAY = 1.0
+MIGRATION_ATTEMPTS = 5
+
+
 class CountingStruct:
     def __init__(self, data: dict, *, guild: utils.discord.Guild) -> None:
         self.guild = guild
         
-        self.channel_id = int(data["channel"])
+        # None in the global ranking, that only reads counting_state
+        self.channel_id = int(data["channel"]) if "channel" in data else None
         self.current_number = data.get("current_number", {"num": 0})
         self.current_number["num"] = int(self.current_number["num"])
         
@@ -25,7 +44,12 @@ class CountingStruct:
         self.record["num"] = int(self.record["num"])
         
         self.fail_role_id = data.get("fail_role")
-        self.users = data.get("users", {})
+        # totals of the guild, the stats of each user are in countings/{guild}/users
+        self.stats: dict[str, int] = dict(data.get("stats", {}))
+        for user_stats in data.get("users", {}).values():
+            # not migrated yet, see migrate_users
+            for field in ("correct", "incorrect"):
+                self.stats[field] = self.stats.get(field, 0) + user_stats.get(field, 0)
     
     @property
     def channel(self):
@@ -38,6 +62,17 @@ class CountingStruct:
         
         return self.guild.get_role(self.fail_role_id)
     
+    def settings(self) -> dict:
+        payload = {
+            "channel": self.channel_id,
+            "numbers_only": self.numbers_only
+        }
+        
+        if self.fail_role_id is not None:
+            payload["fail_role"] = self.fail_role_id
+            
+        return payload
+    
     def to_dict(self) -> dict:
         payload = {
             "channel": self.channel_id,
@@ -53,12 +88,93 @@ class CountingStruct:
         if self.fail_role_id is not None:
             payload["fail_role"] = self.fail_role_id
             
-        if self.users:
-            payload["users"] = self.users
+        if self.stats:
+            payload["stats"] = self.stats
         
         return payload
         
 
+async def _migrate_guild(db: "AsyncClient", doc_ref) -> tuple[int, bool]:
+    """Returns the users moved, and False if the guild kept changing and was left unfinished"""
+    moved = 0
+    attempts = 0
+    while attempts < MIGRATION_ATTEMPTS:
+        doc = await doc_ref.get(["users"])
+        legacy = (doc.to_dict() or {}).get("users")
+        if legacy is None:
+            return moved, True
+        
+        if not legacy:
+            await doc_ref.update({"users": db.DELETE_FIELD})
+            return moved, True
+        
+        chunk = list(legacy.items())[:MIGRATION_CHUNK]
+        totals = {"correct": 0, "incorrect": 0}
+        fields = {}
+        # the values are set, not added, so a chunk written again after a failure is not counted twice
+        async with db.bulk_writer() as writer:
+            for user_id, user_stats in chunk:
+                data = {field: user_stats[field] for field in totals if user_stats.get(field)}
+                if data:
+                    writer.set(db.document(f"{doc_ref.path}/users/{user_id}"), {"migrated": data}, merge=True)
+                
+                for field in totals:
+                    totals[field] += user_stats.get(field, 0)
+                    
+                fields[db.field_path("users", user_id)] = db.DELETE_FIELD
+        
+        batch = db.batch()
+        stats = {field: db.Increment(total) for field, total in totals.items() if total}
+        if stats:
+            batch.set(db.document(f"counting_state/{doc_ref.id}"), {"stats": stats}, merge=True)
+        
+        # only if nobody wrote the guild meanwhile, the totals of a chunk are never added twice
+        batch.update(doc_ref, fields, option=db.write_option(last_update_time=doc.update_time))
+        try:
+            await batch.commit()
+        except exceptions.FailedPrecondition:
+            attempts += 1
+            await utils.asyncio.sleep(MIGRATION_RETRY_DELAY)
+            continue
+        
+        attempts = 0
+        moved += len(chunk)
+    
+    return moved, False
+
+
+async def migrate_users(db: "AsyncClient") -> tuple[int, int, list[str]]:
+    """Moves the ``users`` map of every ``countings/{guild}`` to ``countings/{guild}/users/{user}``
+    
+    The stats of each user are set in the ``migrated`` map of their document,
+    next to the ones counted since.
+    
+    Returns the guilds and users migrated, and the ids of the guilds skipped
+    because they changed during :data:`MIGRATION_ATTEMPTS` attempts in a row.
+    It can be interrupted and run again, or by several processes at once,
+    nobody is counted twice.
+    """
+    guilds = users = 0
+    skipped = []
+    # in pages, a single stream over every guild would outlive its deadline
+    async for page in db.paginate(db.collection("countings").select(["channel"])):
+        for doc in page:
+            # countings/users is not a guild
+            if not doc.id.isdigit():
+                continue
+            
+            moved, complete = await _migrate_guild(db, doc.reference)
+            if moved:
+                guilds += 1
+                users += moved
+            
+            if not complete:
+                print(f"[~] Counting migration: skipped guild {doc.id}, it kept changing", file=sys.stderr)
+                skipped.append(doc.id)
+            
+    return guilds, users, skipped
+
+
 class GlobalStats(ui.View):
     name = "global_stats"
     
@@ -69,7 +185,7 @@ class GlobalStats(ui.View):
         self.num = 0
         
     async def init(self, **kwargs):
-        self.generator = self.client.db.collection("countings").order_by(
+        self.generator = self.client.db.collection("counting_state").order_by(
             "current_number.num", direction=self.client.db.Query.DESCENDING
         ).stream()
         
@@ -113,13 +229,8 @@ class GlobalStats(ui.View):
             )
             
             for counting in countings:
-                correct = 0
-                for c in [user.get("correct", 0) for user in counting.users.values()]:
-                    correct += c
-                
-                incorrect = 0
-                for i in [user.get("incorrect", 0) for user in counting.users.values()]:
-                    incorrect += i
+                correct = counting.stats.get("correct", 0)
+                incorrect = counting.stats.get("incorrect", 0)
                 
                 total = correct + incorrect
                 correct_rate = math.floor(((correct * 100)/total) * 1000)/1000
@@ -177,21 +288,72 @@ class Counting(utils.Cog):
         super().__init__(bot)
         self.countings: dict[int, CountingStruct] = {}
         self.emojis = self.bot.bot_emojis
+        # messages waiting for their check, per counting channel
+        self.queues = SerialQueues(maxsize=QUEUE_SIZE)
+        # reactions, pins and fail roles of the checked messages
+        self._followups: set[utils.asyncio.Task] = set()
 
     async def cog_load(self):
-        await self.get_countings() 
+        for guild_id, data in (self.handed_state() or {}).items():
+            if guild := self.bot.get_guild(guild_id):
+                self.countings[guild_id] = CountingStruct(data, guild=guild)
+        
+        # settings changed elsewhere, the count is in counting_state that nobody listens to
+        self.subscribe("countings", self._on_countings_snapshot, since=self.bot.listen_since)
+        self.bot.scheduler.register(FAIL_ROLE_JOB, self.remove_fail_role)
 
-    async def get_countings(self):
-        db = self.bot.db
-        async for doc_ref in db.collection("countings").list_documents():
-            if doc_ref.id != "users":
-                doc = await doc_ref.get()
-                try:
-                    self.countings[int(doc_ref.id)] = CountingStruct(
-                        doc.to_dict(), guild=await self.bot.fetch_guild(doc_ref.id)
-                    )
-                except utils.discord.Forbidden:
-                    continue
+    async def cog_unload(self):
+        await super().cog_unload()
+        self.queues.close()
+        # the pending jobs wait in the scheduler for the next instance
+        self.bot.scheduler.unregister(FAIL_ROLE_JOB)
+
+    def export_state(self):
+        # raw data, the new instance parses it with its own CountingStruct
+        return {guild_id: counting.to_dict() for guild_id, counting in self.countings.items()}
+
+    async def _on_countings_snapshot(self, docs, changes, initial):
+        for change in changes:
+            # countings/users is not a guild
+            if not change.document.id.isdigit():
+                continue
+            
+            guild_id = int(change.document.id)
+            config = self.bot.guild_configs.peek(guild_id)
+            if config is None:
+                continue
+            
+            data = change.document.to_dict() if change.type != self.bot.db.ChangeType.REMOVED else None
+            # stats written behind after a disable recreate the document without settings
+            if data is None or "channel" not in data:
+                config.counting = None
+                self.countings.pop(guild_id, None)
+                continue
+            
+            counting = self.countings.get(guild_id)
+            if counting is None:
+                # the count read with the config stays, this document only holds settings now
+                count = {key: value for key, value in (config.counting or {}).items() if key in COUNTING_STATE}
+                config.counting = {**merge_counting_state(data, None), **count}
+                continue
+            
+            # the count itself is only written by this process, remote edits are settings
+            counting.channel_id = int(data["channel"])
+            counting.numbers_only = data.get("numbers_only", True)
+            counting.fail_role_id = data.get("fail_role")
+
+    async def get_counting(self, guild: utils.discord.Guild) -> Optional[CountingStruct]:
+        counting = self.countings.get(guild.id)
+        if counting is None:
+            config = await self.bot.get_guild_config(guild.id)
+            if config.counting is not None:
+                counting = self.countings[guild.id] = CountingStruct(config.counting, guild=guild)
+        
+        return counting
+
+    @utils.Cog.listener()
+    async def on_guild_config_evict(self, guild_id: int):
+        self.countings.pop(guild_id, None)
 
     async def update_counting(self, doc_ref, guild_id, key, value): 
         await doc_ref.update({key: value})
@@ -207,7 +369,7 @@ class Counting(utils.Cog):
         numbers_only: Optional[bool] = None,
     ):
         doc_ref = ctx.db.document(f"countings/{ctx.guild.id}")
-        counting = self.countings.get(ctx.guild.id)
+        counting = await self.get_counting(ctx.guild)
         if counting is not None:
             if counting.channel_id != channel.id:
                 counting.channel_id = channel.id
@@ -218,7 +380,7 @@ class Counting(utils.Cog):
             if numbers_only is not None:
                 counting.numbers_only = numbers_only
                 
-            await doc_ref.update(counting.to_dict())
+            await doc_ref.update(counting.settings())
         else:
             data = {
                 "channel": str(channel.id)
@@ -230,6 +392,8 @@ class Counting(utils.Cog):
             if numbers_only is not None:
                 data["numbers_only"] = numbers_only
             
+            config = await self.bot.get_guild_config(ctx.guild.id)
+            config.counting = data
             self.countings[ctx.guild.id] = CountingStruct(data, guild=ctx.guild)
             await doc_ref.set(data)
             
@@ -246,7 +410,13 @@ class Counting(utils.Cog):
             await ctx.send(ctx.translation.confirm.timeout)
         elif view.value:
             await doc_ref.delete()
-            self.countings.pop(doc_ref.id)
+            # behind the count writes still queued, and without the stats not flushed yet
+            state_path = f"counting_state/{ctx.guild.id}"
+            self.bot.stats.discard(state_path)
+            self.bot.outbox.delete(state_path)
+            config = await self.bot.get_guild_config(ctx.guild.id)
+            config.counting = None
+            self.countings.pop(ctx.guild.id, None)
             
             await ctx.send(ctx.translation.confirm.ok)
         else:
@@ -258,7 +428,7 @@ class Counting(utils.Cog):
         
     @utils.commands.hybrid_command()
     async def server_stats(self, ctx: Context):
-        counting = self.countings.get(ctx.guild.id)
+        counting = await self.get_counting(ctx.guild)
         if counting is not None:
             embed = utils.discord.Embed(
                 title=ctx.translation.embed.title,
@@ -293,12 +463,13 @@ class Counting(utils.Cog):
 
         embed.set_author(name=member, icon_url=member.display_avatar.url)
         
-        data = doc.to_dict() or {}
-        if global_stats := data.get("countings"):
-            correct = global_stats.get("correct", 0)
-            incorrect = global_stats.get("incorrect", 0)
-            total = correct + incorrect
-            
+        # plus the increments not written yet
+        global_stats = (doc.to_dict() or {}).get("countings", {})
+        pending = self.bot.stats.pending(f"users/{member.id}")
+        correct = global_stats.get("correct", 0) + pending.get("countings.correct", 0)
+        incorrect = global_stats.get("incorrect", 0) + pending.get("countings.incorrect", 0)
+        total = correct + incorrect
+        if total:
             correct_rate = math.floor(((correct * 100)/total) * 1000)/1000
             incorrect_rate = math.floor(((incorrect * 100)/total) * 1000)/1000
             content = ctx.translation.embed.field_value.format(
@@ -311,69 +482,38 @@ class Counting(utils.Cog):
             )
             embed.add_field(name="🌍 " + ctx.translation.embed.fields_names[0], value=content)
             
-        server_stats = self.countings.get(ctx.guild.id)
-        if server_stats is not None:
-            server_stats = server_stats.users.get(str(member.id))
-            
-            correct = server_stats.get("correct", 0)
-            incorrect = server_stats.get("incorrect", 0)
+        if await self.get_counting(ctx.guild) is not None:
+            path = f"countings/{ctx.guild.id}/users/{member.id}"
+            server_stats = (await ctx.db.document(path).get()).to_dict() or {}
+            migrated = server_stats.get("migrated", {})
+            pending = self.bot.stats.pending(path)
+            correct = server_stats.get("correct", 0) + migrated.get("correct", 0) + pending.get("correct", 0)
+            incorrect = server_stats.get("incorrect", 0) + migrated.get("incorrect", 0) + pending.get("incorrect", 0)
             total = correct + incorrect
-            
-            correct_rate = math.floor(((correct * 100)/total) * 1000)/1000
-            incorrect_rate = math.floor(((incorrect * 100)/total) * 1000)/1000
-            content = ctx.translation.embed.field_value.format(
-                correct_rate,
-                utils.filled_bar(correct_rate),
-                incorrect_rate,
-                utils.filled_bar(incorrect_rate),
-                correct,
-                incorrect
-            )
-            embed.add_field(name="📦 " + ctx.translation.embed.fields_names[1], value=content)
+            if total:
+                correct_rate = math.floor(((correct * 100)/total) * 1000)/1000
+                incorrect_rate = math.floor(((incorrect * 100)/total) * 1000)/1000
+                content = ctx.translation.embed.field_value.format(
+                    correct_rate,
+                    utils.filled_bar(correct_rate),
+                    incorrect_rate,
+                    utils.filled_bar(incorrect_rate),
+                    correct,
+                    incorrect
+                )
+                embed.add_field(name="📦 " + ctx.translation.embed.fields_names[1], value=content)
 
         await ctx.send(embed=embed)
            
-    async def update_user_stats(self, *, guild_id: int, user_id: int, correct: bool):
-        db = self.bot.db
-        
-        doc_ref = db.document(f"users/{user_id}")
-        doc = await doc_ref.get()
-        if doc.exists:
-            if correct:
-                await doc_ref.update({"countings.correct": db.Increment(1)})
-            else:
-                await doc_ref.update({"countings.incorrect": db.Increment(1)})
-        else:
-            await doc_ref.set({
-                "countings": {
-                    "correct": 1 if correct else 0,
-                    "incorrect": 0 if correct else 1
-                }
-            })
-        
-        counting = self.countings.get(guild_id)
-        if counting.users:
-            if correct:
-                user_stats = counting.users.get(str(user_id))
-                if user_stats is not None:
-                    num = user_stats.get("correct", 0)
-                    user_stats.update({"correct": num + 1})
-                else:
-                    counting.users[str(user_id)] = {"correct": 1}
-            else:
-                user_stats = counting.users.get(str(user_id))
-                if user_stats is not None:
-                    num = user_stats.get("incorrect", 0)
-                    user_stats.update({"incorrect": num + 1})
-                else:
-                    counting.users[str(user_id)] = {"incorrect": 1}
-        else:
-            counting.users = {
-                str(user_id): {
-                    "correct": 1 if correct else 0,
-                    "incorrect": 0 if correct else 1
-                }
-            }
+    def update_user_stats(self, counting: CountingStruct, *, user_id: int, correct: bool):
+        # summed in memory and written behind, see utils.accumulator
+        field = "correct" if correct else "incorrect"
+        guild_id = counting.guild.id
+        self.bot.stats.add(f"users/{user_id}", f"countings.{field}")
+        self.bot.stats.add(f"countings/{guild_id}/users/{user_id}", field)
+        self.bot.stats.add(f"counting_state/{guild_id}", f"stats.{field}")
+        
+        counting.stats[field] = counting.stats.get(field, 0) + 1
                                 
     def increase_or_decrease_number(
         self, 
@@ -402,9 +542,9 @@ class Counting(utils.Cog):
         else:
             return 2
 
-    async def pin(self, counting: CountingStruct, channel: utils.discord.TextChannel): 
-        if message_id := counting.current_number.get("message"):
-            if counting.current_number["num"] >= counting.record["num"]:
+    async def pin(self, current_number: dict, record: dict, channel: utils.discord.TextChannel): 
+        if message_id := current_number.get("message"):
+            if current_number["num"] >= record["num"]:
                 old_message = await channel.fetch_message(int(message_id))
                 try:
                     await old_message.pin()
@@ -416,86 +556,119 @@ class Counting(utils.Cog):
         fail_role = counting.fail_role
         if fail_role is not None:
             await member.add_roles(fail_role)
-            await utils.asyncio.sleep(43200.0)            
-            await member.remove_roles(fail_role)
+            self.bot.scheduler.schedule(
+                FAIL_ROLE_DURATION, 
+                FAIL_ROLE_JOB, 
+                {"guild": member.guild.id, "member": member.id, "role": fail_role.id},
+                guild_id=member.guild.id
+            )
+    
+    async def remove_fail_role(self, job: dict):
+        await self.bot.wait_until_ready()
+        guild = self.bot.get_guild(job["guild"])
+        if guild is None:
+            return
+        
+        # by id, the member may not be cached anymore
+        try:
+            await self.bot.http.remove_role(guild.id, job["member"], job["role"])
+        except utils.discord.NotFound:
+            pass
+    
+    def run_after(self, coro: Coroutine):
+        """Runs the follow-up of a checked message without holding its channel queue"""
+        task = utils.asyncio.create_task(coro)
+        self._followups.add(task)
+        task.add_done_callback(self._on_followup_done)
+    
+    def _on_followup_done(self, task: utils.asyncio.Task):
+        self._followups.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print("In counting follow-up:", file=sys.stderr)
+            traceback.print_exception(task.exception())
     
     @utils.Cog.listener()
     async def on_message(self, message: utils.discord.Message): 
-        if message.author.bot:
+        if message.author.bot or message.guild is None:
             return
         
-        counting = self.countings.get(message.guild.id)
-        if counting is not None:
-            if message.channel.id == counting.channel_id:
-                db = self.bot.db
-                doc_ref = db.document(f"countings/{message.guild.id}")
-                try:
-                    content = message.content.replace("^", "**")
-                    result = int(eval(content, {
-                        "pow": math.pow, 
-                        "factorial": math.factorial,
-                        "sqrt": math.sqrt, 
-                        "math": math,
-                        "cmath": cmath,
-                        "print": lambda *_: None,
-                    }, {}))
-                except:
-                    if counting.numbers_only:
-                        await message.add_reaction(self.emojis["no"])
-
-                        await self.update_user_stats(
-                            guild_id=message.guild.id, 
-                            user_id=message.author.id,
-                            correct=False
-                        )
-                        
-                        await self.pin(counting, message.channel)
-                        
-                        try: 
-                            counting.pop("current_number")
-                            await doc_ref.delete(camp="current_number")
-                        except:
-                            pass
-
-                        await self.add_fail_role(counting, message.author)
-                    
-                    return
-                        
-                result = self.increase_or_decrease_number(counting, result, message.author, message)
-                if result == 0:
-                    await message.add_reaction(self.emojis["yes"])
-                    await self.update_user_stats(
-                        guild_id=message.guild.id, 
-                        user_id=message.author.id,
-                        correct=True
-                    )
-                    
-                    await doc_ref.update(counting.to_dict())
-                    return
-                
-                translation = self.translations.event(self.bot.get_guild_lang(message.guild), "counting")
-                await message.add_reaction(self.emojis["no"])
-                
-                if result == 1:
-                    await message.channel.send(
-                        translation.count_twice_in_a_row.format(message.author.mention, self.emojis["disgustado"])
-                    )
-                else:
-                    await message.channel.send(
-                        translation.number_incorrect.format(message.author.mention, self.emojis["disgustado"])
-                    )
+        counting = await self.get_counting(message.guild)
+        if counting is not None and message.channel.id == counting.channel_id:
+            # a burst would interleave at every await, the messages of a channel are checked in order
+            if not self.queues.put(message.channel.id, partial(self.check_message, counting, message)):
+                print(f"[~] Counting: queue of {message.channel.id} is full, message dropped", file=sys.stderr)
+    
+    async def check_message(self, counting: CountingStruct, message: utils.discord.Message):
+        # nothing in here awaits discord, the next message of the channel waits only for the check
+        try:
+            num = arithmetic.evaluate(message.content)
+        except arithmetic.ExpressionError:
+            if counting.numbers_only:
+                await self.fail(counting, message, None)
+            
+            return
                 
-                await self.update_user_stats(
-                    guild_id=message.guild.id, 
-                    user_id=message.author.id,
-                    correct=False
+        result = self.increase_or_decrease_number(counting, num, message.author, message)
+        if result == 0:
+            self.update_user_stats(
+                counting,
+                user_id=message.author.id,
+                correct=True
+            )
+            
+            # merged, the stats are incremented on their own
+            self.bot.outbox.set(
+                f"counting_state/{message.guild.id}", 
+                {"current_number": counting.current_number, "record": counting.record},
+                merge=True
+            )
+            self.run_after(message.add_reaction(self.emojis["yes"]))
+            return
+        
+        await self.fail(counting, message, result)
+    
+    async def fail(self, counting: CountingStruct, message: utils.discord.Message, result: Optional[int]):
+        """Resets the count, ``result`` is None when the message is not a number"""
+        last_number = counting.current_number
+        counting.current_number = {"num": 0}
+        
+        self.update_user_stats(
+            counting,
+            user_id=message.author.id,
+            correct=False
+        )
+        
+        # a number 0 instead of no number, the count of countings/{guild} is not used again
+        self.bot.outbox.set(
+            f"counting_state/{message.guild.id}",
+            {"current_number": {"num": 0, "message": self.bot.db.DELETE_FIELD, "by": self.bot.db.DELETE_FIELD}},
+            merge=True
+        )
+        self.run_after(self.after_fail(counting, message, result, last_number, counting.record))
+    
+    async def after_fail(
+        self, 
+        counting: CountingStruct, 
+        message: utils.discord.Message, 
+        result: Optional[int], 
+        last_number: dict,
+        record: dict
+    ):
+        await message.add_reaction(self.emojis["no"])
+        
+        if result is not None:
+            translation = self.translations.event(self.bot.get_guild_lang(message.guild), "counting")
+            if result == 1:
+                await message.channel.send(
+                    translation.count_twice_in_a_row.format(message.author.mention, self.emojis["disgustado"])
                 )
-                
-                await self.pin(counting, message.channel)
-                
-                counting.current_number = {"num": 0}
-                await doc_ref.delete(camp="current_number")
-                await self.add_fail_role(counting, message.author)
+            else:
+                await message.channel.send(
+                    translation.number_incorrect.format(message.author.mention, self.emojis["disgustado"])
+                )
+        
+        await self.pin(last_number, record, message.channel)
+        await self.add_fail_role(counting, message.author)
                             
     
 async def setup(bot):
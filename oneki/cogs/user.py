@@ -1,9 +1,8 @@
 import utils
-from utils import ui
+from utils import ui, db
 from utils.context import Context
 
 import os
-from PIL import Image
 from typing import Optional, Union
 
 
@@ -85,13 +84,15 @@ class Profile(ui.ExitableView):
         self.user_banner = None
     
     async def init(self, *, member: utils.discord.Member):
-        self.member = member
+        self.member = await self.client.fetch_presence(member)
         self.user = await self.client.fetch_user(self.member.id)
     
     async def get_embed(self, *args) -> utils.discord.Embed:
         if self.user.banner is not None:
             self.user_banner = self.user.banner.url
         else:
+            from PIL import Image
+            
             path = f"resource/img/default_banner_{self.user.id}.png"
             Image.new("RGB", (600, 240), self.user.colour.to_rgb()).save(path)
             
@@ -133,21 +134,49 @@ class User(utils.Cog):
     def __init__(self, bot):
         super().__init__(bot)
         self.afks = {}
+        self.afks_versions = {}
         
     async def cog_load(self):
-        self.afks = await self._get_afks()
+        state = self.handed_state() or self.pop_warm_state()
+        if state is not None:
+            self.afks, self.afks_versions = state
+        else:
+            self.afks = await self._get_afks()
+        
+        self.subscribe("users/afks", self._on_afks_snapshot)
+
+    async def _on_afks_snapshot(self, docs, changes, initial):
+        afks = {}
+        if docs and docs[0].exists:
+            afks = docs[0].to_dict()
+
+        # the snapshot is only restored while it matches the document
+        self.afks_versions = {"users/afks": db.version(docs[0]) if docs else None}
+
+        # apply the diff in place, the dict is shared with running handlers
+        for user_id in self.afks.keys() - afks.keys():
+            self.afks.pop(user_id, None)
+
+        self.afks.update(afks)
         
     async def _get_afks(self):
         # user_id: dict(reason, time)
         afks = {}
 
         doc = await self.bot.db.document("users/afks").get()
+        self.afks_versions = {doc.reference.path: db.version(doc)}
         if doc.exists:
             for key, value in doc.to_dict().items():
                 afks[key] = value
         
         return afks
     
+    def snapshot(self):
+        return self.afks, self.afks_versions
+    
+    def export_state(self):
+        return self.afks, self.afks_versions
+    
     @utils.commands.hybrid_command()
     async def profile(self, ctx: Context, member: Optional[utils.discord.Member] = None):
         member = member or ctx.author
@@ -160,7 +189,7 @@ class User(utils.Cog):
     
     @utils.commands.hybrid_command()
     async def info(self, ctx: Context, member: Optional[utils.discord.Member] = None): 
-        member = member or ctx.author
+        member = await self.bot.fetch_presence(member or ctx.author)
         await ctx.send(embed=MemberInfoEmbed(member, ctx.author, ctx.translation))
     
     # afk
@@ -169,18 +198,12 @@ class User(utils.Cog):
         data = {"reason": reason, "time": utils.utcnow()}
         self.afks[str(user_id)] = data
         
-        doc_ref = self.bot.db.document("users/afks")
-        doc = await doc_ref.get()
-        if doc.exists:
-            await doc_ref.update({str(user_id): data})
-        else:
-            await doc_ref.set(self.afks)
+        self.bot.outbox.set("users/afks", {str(user_id): data}, merge=True)
 
     async def remove_from_afk(self, user_id):
         self.afks.pop(str(user_id))
         
-        doc_ref = self.bot.db.document("users/afks")
-        await doc_ref.delete(str(user_id))
+        self.bot.outbox.update("users/afks", {str(user_id): self.bot.db.DELETE_FIELD})
 
     @utils.commands.hybrid_command()
     async def afk(self, ctx: Context, *, reason=None):
@@ -1,12 +1,51 @@
 import traceback
+import hashlib
+import json
 import sys
 
 import discord
 from discord import app_commands
 from utils.ui import ReportBug
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from utils.db import AsyncClient
 
 
 class CommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return not interaction.client.blacklist.is_blacklisted(interaction.user.id, interaction.guild_id)
+
+    async def get_payload(self) -> list[dict]:
+        """Returns the global commands as sent by :meth:`sync`, in a stable order"""
+        commands = self._get_all_commands()
+        if self.translator:
+            payload = [await command.get_translated_payload(self, self.translator) for command in commands]
+        else:
+            payload = [command.to_dict(self) for command in commands]
+        
+        return sorted(payload, key=lambda command: (command.get("type", 1), command["name"]))
+
+    async def fingerprint(self) -> str:
+        payload = await self.get_payload()
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+    async def sync_if_changed(self, db: "AsyncClient", *, force: bool = False) -> bool:
+        """Syncs the global commands only if they changed since the last sync
+
+        The fingerprint of the last synced tree is kept in
+        ``command_trees/{application_id}``. Returns whether a sync happened.
+        """
+        fingerprint = await self.fingerprint()
+        doc_ref = db.document(f"command_trees/{self.client.application_id}")
+        doc = await doc_ref.get()
+        if not force and doc.exists and doc.get("fingerprint") == fingerprint:
+            return False
+        
+        await self.sync()
+        await doc_ref.set({"fingerprint": fingerprint, "synced_at": discord.utils.utcnow()})
+        return True
+
     async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
         err = getattr(error, "original", error)
         if isinstance(err, app_commands.CommandNotFound): 
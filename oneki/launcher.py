@@ -0,0 +1,51 @@
+from bot import ShardedOnekiBot
+from utils import env, ipc
+
+import asyncio
+import multiprocessing
+import sys
+
+
+# discord lets a bot identify one shard every 5 seconds
+IDENTIFY_INTERVAL = 5.0
+
+
+def run_worker(worker_id: int, shard_ids: list[int], shard_count: int):
+    # kept out of __main__, a spawned worker imports its target by module name
+    bot = ShardedOnekiBot(worker_id=worker_id, shard_ids=shard_ids, shard_count=shard_count)
+    bot.run()
+
+
+def shard_ranges(shard_count: int, processes: int) -> list[list[int]]:
+    per_process = -(-shard_count // processes)
+    return [list(range(i, min(i + per_process, shard_count))) for i in range(0, shard_count, per_process)]
+
+
+async def launch(shard_count: int, processes: int):
+    broker = ipc.Broker(port=int(env.IPC_PORT or ipc.DEFAULT_PORT))
+    await broker.start()
+    
+    mp = multiprocessing.get_context("spawn")
+    workers: dict[int, multiprocessing.Process] = {}
+    ranges = shard_ranges(shard_count, processes)
+    
+    def start_worker(worker_id: int):
+        process = mp.Process(
+            target=run_worker, 
+            args=(worker_id, ranges[worker_id], shard_count), 
+            name=f"oneki-worker-{worker_id}"
+        )
+        process.start()
+        workers[worker_id] = process
+        print(f"[+] Worker {worker_id} started with shards {ranges[worker_id]}")
+        
+    for worker_id, shard_ids in enumerate(ranges):
+        start_worker(worker_id)
+        await asyncio.sleep(IDENTIFY_INTERVAL * len(shard_ids))
+    
+    while True:
+        await asyncio.sleep(IDENTIFY_INTERVAL)
+        for worker_id, process in list(workers.items()):
+            if not process.is_alive():
+                print(f"[~] Worker {worker_id} exited with code {process.exitcode}, restarting", file=sys.stderr)
+                start_worker(worker_id)
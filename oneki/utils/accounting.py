@@ -0,0 +1,135 @@
+from bisect import bisect_left
+from typing import Any, Optional
+
+import datetime
+import os
+import sys
+
+
+# upper bounds in milliseconds of the latency histogram buckets, the last one is unbounded
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+# seconds between two reports while running
+REPORT_INTERVAL = 3600.0
+
+# frames of these files are not call sites, they run the operations for someone else
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SKIPPED = {os.path.join(_ROOT, "utils", name) for name in ("db.py", "accounting.py", "outbox.py", "accumulator.py", "fake_firestore.py")}
+
+
+def payload_size(value: Any) -> int:
+    """Approximate storage size of a value, following the firestore size rules"""
+    if value is None or isinstance(value, bool):
+        return 1
+    elif isinstance(value, (int, float, datetime.datetime)):
+        return 8
+    elif isinstance(value, str):
+        return len(value.encode()) + 1
+    elif isinstance(value, bytes):
+        return len(value)
+    elif isinstance(value, dict):
+        return sum(len(str(key).encode()) + 1 + payload_size(v) for key, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        return sum(payload_size(v) for v in value)
+
+    # transforms, references and geo points
+    return 8
+
+
+def call_site(depth: int = 1) -> str:
+    """Returns the innermost function of the bot in the stack that is not part of the data layer"""
+    frame = sys._getframe(depth)
+    fallback = None
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_ROOT):
+            code = frame.f_code
+            name = f"{frame.f_globals.get('__name__')}.{getattr(code, 'co_qualname', code.co_name)}"
+            if filename not in _SKIPPED:
+                return name
+
+            # background tasks of the data layer, like the outbox drain
+            fallback = name
+
+        frame = frame.f_back
+
+    return fallback or "<unknown>"
+
+
+class OperationStats:
+    __slots__ = ("calls", "documents", "bytes", "total_ms", "histogram")
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.documents = 0
+        self.bytes = 0
+        self.total_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def percentile(self, p: float) -> str:
+        """Returns the upper bound of the bucket that holds the ``p`` percentile"""
+        target = p * sum(self.histogram)
+        seen = 0
+        for i, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return f"{LATENCY_BUCKETS[i]}ms" if i < len(LATENCY_BUCKETS) else f">{LATENCY_BUCKETS[-1]}ms"
+
+        return "-"
+
+
+class Accounting:
+    """Counts the firestore operations of every call site
+
+    Operations are ``read``, ``write`` and ``delete`` (billed documents),
+    ``commit`` (write RPCs) and ``queued`` (writes left in the outbox by the
+    site, they are billed later to the outbox drain).
+    """
+    def __init__(self) -> None:
+        self.since = datetime.datetime.now(datetime.timezone.utc)
+        # (site, operation): stats
+        self.stats: dict[tuple[str, str], OperationStats] = {}
+
+    def record(
+        self,
+        operation: str,
+        site: str,
+        *,
+        documents: int = 1,
+        nbytes: int = 0,
+        elapsed: Optional[float] = None
+    ):
+        stats = self.stats.get((site, operation))
+        if stats is None:
+            stats = self.stats[(site, operation)] = OperationStats()
+
+        stats.calls += 1
+        stats.documents += documents
+        stats.bytes += nbytes
+        if elapsed is not None:
+            ms = elapsed * 1000
+            stats.total_ms += ms
+            stats.histogram[bisect_left(LATENCY_BUCKETS, ms)] += 1
+
+    def reset(self):
+        self.__init__()
+
+    def report(self, limit: Optional[int] = None) -> str:
+        """Returns a table of the call sites, the ones that bill more documents first"""
+        lines = [
+            f"since {self.since:%Y-%m-%d %H:%M} UTC",
+            f"{'operation':<9} {'calls':>7} {'docs':>8} {'bytes':>10} {'avg':>8} {'p50':>7} {'p99':>7}  site"
+        ]
+        rows = sorted(self.stats.items(), key=lambda item: item[1].documents, reverse=True)
+        for (site, operation), stats in rows[:limit]:
+            timed = sum(stats.histogram)
+            average = f"{stats.total_ms / timed:.1f}ms" if timed else "-"
+            lines.append(
+                f"{operation:<9} {stats.calls:>7} {stats.documents:>8} {stats.bytes:>10} "
+                f"{average:>8} {stats.percentile(0.5):>7} {stats.percentile(0.99):>7}  {site}"
+            )
+
+        return "\n".join(lines)
+
+
+# operations of this process
+accounting = Accounting()
@@ -0,0 +1,92 @@
+from google.cloud.firestore_v1 import transforms
+from typing import Optional, TYPE_CHECKING
+
+import asyncio
+import sys
+import traceback
+
+from .accounting import call_site
+
+if TYPE_CHECKING:
+    from .outbox import Outbox
+
+
+# seconds between two flushes, and documents with pending increments that force one
+FLUSH_INTERVAL = 30.0
+MAX_PENDING = 1000
+
+
+class Accumulator:
+    """Sums increments per document in memory and writes them behind
+
+    Every flush queues one merged write of ``Increment`` transforms per
+    document in the outbox, however many times its fields were incremented,
+    so the writes follow the active documents instead of the events. The
+    increments since the last flush are lost if the process crashes.
+    """
+    def __init__(self, outbox: "Outbox", *, interval: float = FLUSH_INTERVAL, max_pending: int = MAX_PENDING) -> None:
+        self._outbox = outbox
+        self.interval = interval
+        self.max_pending = max_pending
+        # path: field path: delta
+        self._pending: dict[str, dict[str, int]] = {}
+        # path: call site of its first pending increment, the write is accounted to it
+        self._sites: dict[str, str] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def add(self, path: str, field_path: str, delta: int = 1):
+        fields = self._pending.get(path)
+        if fields is None:
+            fields = self._pending[path] = {}
+            self._sites[path] = call_site()
+
+        fields[field_path] = fields.get(field_path, 0) + delta
+        if len(self._pending) >= self.max_pending:
+            self.flush()
+
+    def pending(self, path: str) -> dict[str, int]:
+        """Returns the increments of ``path`` not written yet, by field path"""
+        return dict(self._pending.get(path, {}))
+
+    def discard(self, path: str):
+        """Drops the increments of ``path`` not written yet, they would create it again after a delete"""
+        self._pending.pop(path, None)
+        self._sites.pop(path, None)
+
+    def flush(self):
+        pending, self._pending = self._pending, {}
+        sites, self._sites = self._sites, {}
+        for path, fields in pending.items():
+            data = {}
+            for field_path, delta in fields.items():
+                *parents, name = field_path.split(".")
+                parent = data
+                for key in parents:
+                    parent = parent.setdefault(key, {})
+
+                parent[name] = transforms.Increment(delta)
+
+            # a merge creates the document if needed, the increments start from 0
+            self._outbox.set(path, data, merge=True, site=sites.get(path))
+
+    def start(self):
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:
+                print("[~] Accumulator: flush failed", file=sys.stderr)
+                traceback.print_exc()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        self.flush()
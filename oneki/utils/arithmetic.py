@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from typing import Callable, Union
+
+import ast
+import math
+
+
+# limits that keep the cost of a single expression bounded
+MAX_LENGTH = 256
+MAX_NODES = 256
+MAX_INT_BITS = 4096
+MAX_FACTORIAL = 500
+CACHE_SIZE = 1024
+
+Number = Union[int, float]
+
+
+class ExpressionError(ValueError):
+    """The message is not an expression that can be evaluated within the limits"""
+
+
+def _check_int(value: Number) -> Number:
+    if isinstance(value, int) and value.bit_length() > MAX_INT_BITS:
+        raise ExpressionError("operand too large")
+
+    return value
+
+
+def _check_factorial(n: Number) -> Number:
+    if not isinstance(n, int) or isinstance(n, bool):
+        raise ExpressionError("factorial of a non integer")
+    elif n > MAX_FACTORIAL:
+        raise ExpressionError("factorial argument too large")
+
+    return n
+
+
+def _mul(a: Number, b: Number) -> Number:
+    if isinstance(a, int) and isinstance(b, int) and a.bit_length() + b.bit_length() > MAX_INT_BITS:
+        raise ExpressionError("product too large")
+
+    return a * b
+
+
+def _pow(base: Number, exponent: Number) -> Number:
+    # the size of an integer power is known before computing it
+    if isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and abs(base) > 1:
+        if (abs(base).bit_length() - 1) * exponent > MAX_INT_BITS:
+            raise ExpressionError("power too large")
+
+    return base ** exponent
+
+
+def _factorial(n: Number) -> int:
+    return math.factorial(_check_factorial(n))
+
+
+def _comb(n: Number, k: Number) -> int:
+    return math.comb(_check_factorial(n), k)
+
+
+def _perm(n: Number, k: Number = None) -> int:
+    return math.perm(_check_factorial(n), k)
+
+
+_BINARY_OPERATORS: dict[type, Callable[[Number, Number], Number]] = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: _mul,
+    ast.Div: lambda a, b: a / b,
+    ast.FloorDiv: lambda a, b: a // b,
+    ast.Mod: lambda a, b: a % b,
+    ast.Pow: _pow
+}
+
+_UNARY_OPERATORS: dict[type, Callable[[Number], Number]] = {
+    ast.UAdd: lambda a: +a,
+    ast.USub: lambda a: -a
+}
+
+# what the counting channels could call, pow is math.pow like before
+_FUNCTIONS: dict[str, Callable] = {
+    "pow": math.pow,
+    "factorial": _factorial,
+    "sqrt": math.sqrt
+}
+
+# math.<name>
+_MATH: dict[str, Union[Callable, float]] = {
+    **{
+        name: getattr(math, name) for name in (
+            "sqrt", "isqrt", "pow", "exp", "log", "log2", "log10", "floor", "ceil", "trunc", "fabs",
+            "sin", "cos", "tan", "asin", "acos", "atan", "atan2", "sinh", "cosh", "tanh",
+            "degrees", "radians", "hypot", "gcd", "lcm", "pi", "e", "tau"
+        )
+    },
+    "factorial": _factorial,
+    "comb": _comb,
+    "perm": _perm
+}
+
+
+def _function(node: ast.expr) -> Callable:
+    if isinstance(node, ast.Name) and node.id in _FUNCTIONS:
+        return _FUNCTIONS[node.id]
+    elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "math":
+        function = _MATH.get(node.attr)
+        if callable(function):
+            return function
+
+    raise ExpressionError("unknown function")
+
+
+def _eval(node: ast.AST) -> Number:
+    if isinstance(node, ast.Constant):
+        # bools and complex literals are not numbers of the count
+        if type(node.value) not in (int, float):
+            raise ExpressionError("not a number")
+
+        return _check_int(node.value)
+    elif isinstance(node, ast.BinOp):
+        operator = _BINARY_OPERATORS.get(type(node.op))
+        if operator is None:
+            raise ExpressionError("unsupported operator")
+
+        return _check_int(operator(_eval(node.left), _eval(node.right)))
+    elif isinstance(node, ast.UnaryOp):
+        operator = _UNARY_OPERATORS.get(type(node.op))
+        if operator is None:
+            raise ExpressionError("unsupported operator")
+
+        return operator(_eval(node.operand))
+    elif isinstance(node, ast.Call):
+        if node.keywords or any(isinstance(arg, ast.Starred) for arg in node.args):
+            raise ExpressionError("unsupported call")
+
+        function = _function(node.func)
+        return _check_int(function(*(_eval(arg) for arg in node.args)))
+    elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "math":
+        constant = _MATH.get(node.attr)
+        if isinstance(constant, float):
+            return constant
+
+    raise ExpressionError(f"unsupported {type(node).__name__}")
+
+
+def _evaluate(content: str) -> int:
+    content = content.strip()
+    # most messages of a counting channel are a plain number
+    if content.isascii() and content.isdigit():
+        return _check_int(int(content))
+
+    if len(content) > MAX_LENGTH:
+        raise ExpressionError("expression too long")
+
+    try:
+        tree = ast.parse(content.replace("^", "**"), mode="eval")
+    except (SyntaxError, ValueError) as e:
+        raise ExpressionError("invalid syntax") from e
+
+    if sum(1 for _ in ast.walk(tree)) > MAX_NODES:
+        raise ExpressionError("expression too complex")
+
+    try:
+        return int(_eval(tree.body))
+    except ExpressionError:
+        raise
+    except (ArithmeticError, ValueError, TypeError) as e:
+        raise ExpressionError(str(e)) from e
+
+
+_cache: OrderedDict[str, Union[int, ExpressionError]] = OrderedDict()
+
+
+def evaluate(content: str) -> int:
+    """Returns the integer value of the arithmetic expression of a message
+
+    Replaces ``int(eval(content))`` in the counting channels, ``^`` is a power.
+    Raises :class:`ExpressionError` when the message is not an expression or
+    evaluating it would exceed the limits above. Results are cached, the same
+    numbers and expressions are sent over and over.
+    """
+    result = _cache.get(content)
+    if result is None:
+        try:
+            result = _evaluate(content)
+        except ExpressionError as e:
+            result = e
+
+        _cache[content] = result
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(content)
+
+    if isinstance(result, ExpressionError):
+        raise ExpressionError(*result.args)
+
+    return result
@@ -0,0 +1,96 @@
+from typing import Iterable, Mapping, Optional, TYPE_CHECKING
+
+from .db import version
+
+if TYPE_CHECKING:
+    from .db import AsyncClient
+
+
+USERS = "users"
+GUILDS = "guilds"
+
+# fields written by a single operation (firestore limit)
+FIELDS_PER_WRITE = 500
+
+
+def ids_of(data: dict) -> set[str]:
+    """Returns the ids of a blacklist document, other keys are ignored"""
+    return {key for key in data if key.isdigit()}
+
+
+class Blacklist:
+    """Integer-keyed index of the globally blacklisted users and guilds
+
+    Mirrors the ``blacklist/users`` and ``blacklist/guilds`` documents,
+    which map ids to the reason of the ban.
+    """
+    __slots__ = ("users", "guilds", "versions")
+
+    def __init__(self, *, users: Iterable = (), guilds: Iterable = ()) -> None:
+        self.users: set[int] = {int(i) for i in users}
+        self.guilds: set[int] = {int(i) for i in guilds}
+        # path: revision of the documents when they were read, see db.version
+        self.versions: dict[str, Optional[str]] = {}
+
+    def __repr__(self) -> str:
+        return f"<Blacklist users={len(self.users)} guilds={len(self.guilds)}>"
+
+    @classmethod
+    async def fetch(cls, db: "AsyncClient") -> "Blacklist":
+        blacklist = cls()
+        async for doc in db.get_all([db.document(f"blacklist/{USERS}"), db.document(f"blacklist/{GUILDS}")]):
+            blacklist.versions[doc.reference.path] = version(doc)
+            if doc.exists:
+                blacklist.replace(doc.id, ids_of(doc.to_dict()))
+
+        return blacklist
+
+    def to_state(self) -> dict:
+        return {USERS: list(self.users), GUILDS: list(self.guilds)}
+
+    @classmethod
+    def from_state(cls, state: dict, versions: dict[str, Optional[str]]) -> "Blacklist":
+        blacklist = cls(users=state[USERS], guilds=state[GUILDS])
+        blacklist.versions = versions
+        return blacklist
+
+    def _ids(self, kind: str) -> set[int]:
+        if kind == USERS:
+            return self.users
+        elif kind == GUILDS:
+            return self.guilds
+
+        raise ValueError(f"unknown blacklist {kind!r}")
+
+    def is_blacklisted(self, user_id: Optional[int] = None, guild_id: Optional[int] = None) -> bool:
+        return user_id in self.users or guild_id in self.guilds
+
+    def add(self, kind: str, ids: Iterable):
+        self._ids(kind).update(int(i) for i in ids)
+
+    def discard(self, kind: str, ids: Iterable):
+        self._ids(kind).difference_update(int(i) for i in ids)
+
+    def replace(self, kind: str, ids: Iterable):
+        ids = {int(i) for i in ids}
+        index = self._ids(kind)
+        # in place, the fast paths hold a reference to the sets
+        index.intersection_update(ids)
+        index.update(ids)
+
+    async def _commit(self, db: "AsyncClient", kind: str, fields: list[tuple[str, object]]):
+        doc_ref = db.document(f"blacklist/{kind}")
+        # the writes of one document are sent one batch after the other, see db.BulkWriter
+        async with db.bulk_writer() as writer:
+            for i in range(0, len(fields), FIELDS_PER_WRITE):
+                writer.set(doc_ref, dict(fields[i:i + FIELDS_PER_WRITE]), merge=True)
+
+    async def add_many(self, db: "AsyncClient", kind: str, entries: Mapping[int, Optional[str]]):
+        """Blacklists every id of ``entries``, a mapping of id to reason"""
+        await self._commit(db, kind, [(str(i), reason) for i, reason in entries.items()])
+        self.add(kind, entries)
+
+    async def remove_many(self, db: "AsyncClient", kind: str, ids: Iterable[int]):
+        ids = {int(i) for i in ids}
+        await self._commit(db, kind, [(str(i), db.DELETE_FIELD) for i in ids])
+        self.discard(kind, ids)
@@ -0,0 +1,38 @@
+import discord
+
+
+FULL = "full"
+LEAN = "lean"
+
+
+def get_intents() -> discord.Intents:
+    return discord.Intents(
+        guilds=True,
+        members=True,
+        presences=True,
+        voice_states=True,
+        messages=True,
+        message_content=True,
+        bans=True
+    )
+
+
+def get_cache_options(profile: str = FULL) -> dict:
+    """Returns the gateway and cache options of the client for ``profile``
+
+    ``full`` caches every member with its presence. ``lean`` only caches the
+    members in voice channels and does not chunk guilds, presence updates of
+    uncached members are discarded and presences are queried on demand.
+    """
+    intents = get_intents()
+    if profile == FULL:
+        return {"intents": intents}
+    elif profile == LEAN:
+        return {
+            # the presences intent is kept, query_members needs it to return presences
+            "intents": intents,
+            "member_cache_flags": discord.MemberCacheFlags(voice=True, joined=False),
+            "chunk_guilds_at_startup": False
+        }
+
+    raise ValueError(f"unknown cache profile {profile!r}")
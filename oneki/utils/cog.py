@@ -1,13 +1,77 @@
 from discord.ext import commands
-from typing import TYPE_CHECKING
+from typing import Any, Awaitable, Callable, Optional, TYPE_CHECKING
 
 if TYPE_CHECKING:
     from bot import OnekiBot
+    from .db import Subscription
     from .translations import Translations
 
 
+class Handoff:
+    """State passed by a cog to the instance that replaces it on reload"""
+    __slots__ = ("state", "subscriptions")
+
+    def __init__(self, state: Any, subscriptions: dict[str, "Subscription"]) -> None:
+        self.state = state
+        self.subscriptions = subscriptions
+
+    def close(self):
+        # the subscriptions the new instance did not take
+        for subscription in self.subscriptions.values():
+            subscription.close()
+
+        self.subscriptions = {}
+
+
 class Cog(commands.Cog):
     def __init__(self, bot) -> None:
         self.bot: OnekiBot = bot
-        self.translations: Translations = bot.translations
-        
\ No newline at end of file
+        self.subscriptions: dict[str, Subscription] = {}
+        # set when the cog replaces a reloaded instance, see OnekiBot.reload_extension_with_state
+        self._handoff: Optional[Handoff] = bot.handoffs.pop(self.qualified_name, None)
+
+    @property
+    def translations(self) -> "Translations":
+        # read on every use, the bot swaps them on reload
+        return self.bot.translations
+
+    async def cog_unload(self):
+        for subscription in self.subscriptions.values():
+            subscription.close()
+
+    def subscribe(self, path: str, callback: Callable[[list, list, bool], Awaitable[None]], **options) -> "Subscription":
+        """Subscribes to ``path``, or takes over the subscription of the reloaded instance
+
+        ``options`` are passed to :meth:`db.AsyncClient.subscribe`.
+        """
+        subscription = self._handoff.subscriptions.pop(path, None) if self._handoff else None
+        if subscription is None:
+            subscription = self.bot.db.subscribe(path, callback, **options)
+        else:
+            subscription.callback = callback
+
+        self.subscriptions[path] = subscription
+        return subscription
+
+    def export_state(self) -> Any:
+        """Returns the in-memory state handed to the new instance when the cog is reloaded"""
+        return None
+
+    def handoff(self) -> Handoff:
+        handoff = Handoff(self.export_state(), self.subscriptions)
+        # they belong to the new instance now, cog_unload must not close them
+        self.subscriptions = {}
+        return handoff
+
+    def handed_state(self) -> Any:
+        """Returns the state exported by the reloaded instance, None on a cold load"""
+        return self._handoff.state if self._handoff is not None else None
+
+    def snapshot(self) -> Optional[tuple[Any, dict[str, Optional[str]]]]:
+        """Returns the in-memory state kept between restarts and the revisions
+        of the documents it was read from, or None to keep nothing"""
+        return None
+
+    def pop_warm_state(self) -> Optional[tuple[Any, dict[str, Optional[str]]]]:
+        """Returns the state saved by :meth:`snapshot` if it is still fresh"""
+        return self.bot.warm_state.pop(f"cog/{self.qualified_name}", None)
@@ -0,0 +1,212 @@
+from collections import OrderedDict
+from typing import Callable, Optional, TYPE_CHECKING
+
+import asyncio
+
+from .prefix import PrefixMatcher
+from .db import version, is_unavailable
+
+if TYPE_CHECKING:
+    from .db import AsyncClient
+
+
+DEFAULT_PREFIXES = ['?', '>']
+CLUBS_SETTINGS = ["approval_channel", "clubs_category", "nsfw_clubs_enabled"]
+COUNTING_SETTINGS = ["channel", "numbers_only", "fail_role"]
+# fields of counting_state/{id}, the count written on every message, kept
+# out of the listened countings/{id} where older guilds still have them
+COUNTING_STATE = ["current_number", "record", "stats"]
+
+
+def merge_counting_state(counting: dict, state: Optional[dict]) -> dict:
+    """Returns the settings of ``countings/{id}`` with the count of ``counting_state/{id}``
+
+    The count of ``countings/{id}`` is used until ``counting_state/{id}``
+    has its own, the stats of both are added up.
+    """
+    state = state or {}
+    merged = {key: value for key, value in counting.items() if key not in COUNTING_STATE}
+    for key in ("current_number", "record"):
+        value = state.get(key, counting.get(key))
+        if value is not None:
+            merged[key] = value
+
+    stats = dict(counting.get("stats", {}))
+    for field, value in state.get("stats", {}).items():
+        stats[field] = stats.get(field, 0) + value
+
+    if stats:
+        merged["stats"] = stats
+
+    return merged
+
+
+class GuildConfig:
+    """Configuration of a guild gathered from every document that configures it"""
+    __slots__ = ("guild_id", "_prefixes", "_prefix_matcher", "clubs", "counting", "versions")
+
+    def __init__(
+        self,
+        guild_id: int,
+        *,
+        prefixes: Optional[list[str]] = None,
+        clubs: Optional[dict] = None,
+        counting: Optional[dict] = None,
+        versions: Optional[dict[str, Optional[str]]] = None
+    ) -> None:
+        self.guild_id = guild_id
+        self.prefixes: list[str] = prefixes or DEFAULT_PREFIXES.copy()
+        # settings stored in guilds/{id}/clubs/wait_approval
+        self.clubs: dict = clubs or {}
+        # countings/{id} with the count of counting_state/{id}, None if counting is disabled
+        self.counting: Optional[dict] = counting
+        # path: revision of the documents above when they were read, see db.version
+        self.versions: dict[str, Optional[str]] = versions or {}
+
+    @property
+    def prefixes(self) -> list[str]:
+        return self._prefixes
+
+    @prefixes.setter
+    def prefixes(self, value: list[str]):
+        self._prefixes = value
+        self._prefix_matcher = None
+
+    def get_prefix_matcher(self, base: tuple[str, ...] = ()) -> PrefixMatcher:
+        """Returns the matcher of ``base`` plus the guild prefixes, built on first use
+
+        ``base`` must be the same on every call, it is only read when the
+        matcher is (re)built after a change of prefixes.
+        """
+        if self._prefix_matcher is None:
+            self._prefix_matcher = PrefixMatcher((*base, *self._prefixes))
+
+        return self._prefix_matcher
+
+    @classmethod
+    async def fetch(cls, db: "AsyncClient", guild_id: int) -> "GuildConfig":
+        guild_ref = db.document(f"guilds/{guild_id}")
+        clubs_ref = db.document(f"guilds/{guild_id}/clubs/wait_approval")
+        counting_ref = db.document(f"countings/{guild_id}")
+        state_ref = db.document(f"counting_state/{guild_id}")
+
+        # one round trip for the four documents, the mask leaves out the pending clubs
+        docs = {}
+        versions = {}
+        async for doc in db.get_all(
+            [guild_ref, clubs_ref, counting_ref, state_ref],
+            field_paths=["prefixes", *CLUBS_SETTINGS, *COUNTING_SETTINGS, *COUNTING_STATE]
+        ):
+            versions[doc.reference.path] = version(doc)
+            if doc.exists:
+                docs[doc.reference.path] = doc.to_dict()
+
+        guild_data = docs.get(guild_ref.path, {})
+        counting = docs.get(counting_ref.path)
+        if counting is not None and "channel" not in counting:
+            # no settings, like the ones left by stats written behind after a disable
+            counting = None
+        elif counting is not None:
+            counting = merge_counting_state(counting, docs.get(state_ref.path))
+
+        return cls(
+            guild_id,
+            prefixes=guild_data.get("prefixes"),
+            clubs=docs.get(clubs_ref.path),
+            counting=counting,
+            versions=versions
+        )
+
+    async def reload_clubs(self, db: "AsyncClient"):
+        """Reads the clubs settings again, after they were written"""
+        doc = await db.document(f"guilds/{self.guild_id}/clubs/wait_approval").get(CLUBS_SETTINGS)
+        self.clubs = doc.to_dict() if doc.exists else {}
+        self.versions[doc.reference.path] = version(doc)
+
+    def to_state(self) -> dict:
+        return {
+            "guild_id": self.guild_id,
+            "prefixes": self.prefixes,
+            "clubs": self.clubs,
+            "counting": self.counting
+        }
+
+    @classmethod
+    def from_state(cls, state: dict, versions: dict[str, Optional[str]]) -> "GuildConfig":
+        return cls(state.pop("guild_id"), versions=versions, **state)
+
+
+class GuildConfigCache:
+    """Bounded LRU of :class:`GuildConfig` loaded the first time a guild is touched"""
+    def __init__(
+        self,
+        db: "AsyncClient",
+        *,
+        maxsize: int = 1024,
+        on_evict: Optional[Callable[[int], None]] = None
+    ) -> None:
+        self._db = db
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._configs: OrderedDict[int, GuildConfig] = OrderedDict()
+        self._loading: dict[int, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._configs)
+
+    def __contains__(self, guild_id: int) -> bool:
+        return guild_id in self._configs
+
+    def peek(self, guild_id: int) -> Optional[GuildConfig]:
+        """Returns the cached config without loading it"""
+        config = self._configs.get(guild_id)
+        if config is not None:
+            self._configs.move_to_end(guild_id)
+
+        return config
+
+    async def get(self, guild_id: int) -> GuildConfig:
+        config = self.peek(guild_id)
+        if config is not None:
+            return config
+
+        # concurrent misses of the same guild share a single load
+        task = self._loading.get(guild_id)
+        if task is None:
+            task = self._loading[guild_id] = asyncio.create_task(self._load(guild_id))
+
+        try:
+            return await asyncio.shield(task)
+        except Exception as e:
+            if not is_unavailable(e):
+                raise
+
+            # defaults while firestore is down, not cached so a later call loads the real config
+            return GuildConfig(guild_id)
+
+    async def _load(self, guild_id: int) -> GuildConfig:
+        try:
+            config = await GuildConfig.fetch(self._db, guild_id)
+        finally:
+            self._loading.pop(guild_id, None)
+
+        self.put(config)
+        return config
+
+    def put(self, config: GuildConfig):
+        self._configs[config.guild_id] = config
+        self._configs.move_to_end(config.guild_id)
+        while len(self._configs) > self.maxsize:
+            evicted, _ = self._configs.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted)
+
+    def values(self) -> list[GuildConfig]:
+        return list(self._configs.values())
+
+    def pop(self, guild_id: int) -> Optional[GuildConfig]:
+        config = self._configs.pop(guild_id, None)
+        if config is not None and self.on_evict is not None:
+            self.on_evict(guild_id)
+
+        return config
@@ -1,12 +1,152 @@
 from firebase_admin import credentials, firestore
+from google.cloud.firestore_v1.watch import ChangeType
+from google.cloud.firestore_v1.bulk_batch import BulkWriteBatch
+from google.api_core import exceptions, gapic_v1
 import firebase_admin
 
 from utils import env
+from utils.timeline import timeline
+from utils.accounting import accounting, call_site, payload_size
+from collections import OrderedDict
+from functools import partial
 from json import loads
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Optional
 
+import asyncio
+import datetime
+import random
+import time
+import traceback
+import sys
 
-cred = credentials.Certificate(loads(env.GOOGLE_APPLICATION_CREDENTIALS))
-firebase_app = firebase_admin.initialize_app(cred)
+
+# documents per RPC when paging through a collection
+DEFAULT_PAGE_SIZE = 500
+
+# collection id: seconds AsyncDocumentReference.get caches its snapshots,
+# the documents of other collections are always read from firestore
+CACHE_TTLS = {
+    "users": 60.0,
+    "clubs": 30.0
+}
+CACHE_SIZE = 4096
+
+# seconds a listener looks back before its start to cover the skew between the clocks
+LISTEN_CLOCK_SKEW = 60.0
+
+# writes per BatchWrite RPC (firestore limit), RPCs in flight and seconds a
+# partial batch waits for more writes, see BulkWriter
+BULK_BATCH_SIZE = 500
+BULK_CONCURRENCY = 4
+BULK_FLUSH_INTERVAL = 1.0
+
+# seconds a single call may take, and attempts of the idempotent ones, see AsyncClient.call
+CALL_DEADLINE = 10.0
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 0.2
+# consecutive failures that open the breaker, and seconds until it tries again
+BREAKER_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30.0
+
+# firestore could not answer, another attempt may succeed
+TRANSIENT_ERRORS = (
+    asyncio.TimeoutError,
+    exceptions.ServiceUnavailable,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.Aborted,
+    exceptions.TooManyRequests,
+    exceptions.RetryError
+)
+
+
+def version(doc) -> Optional[str]:
+    """Returns the revision of a document snapshot, None if the document does not exist"""
+    return doc.update_time.rfc3339() if doc.exists else None
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling firestore while the circuit breaker is open"""
+
+
+def is_unavailable(error: BaseException) -> bool:
+    """Whether ``error`` means firestore could not be reached, the open breaker included"""
+    return isinstance(error, (CircuitOpenError, *TRANSIENT_ERRORS))
+
+
+class CircuitBreaker:
+    """Fails calls fast after ``threshold`` consecutive transient failures
+
+    Once open, calls raise :class:`CircuitOpenError` for ``reset_timeout``
+    seconds, then a single trial call goes through (half open): its success
+    closes the breaker, its failure opens it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, *, threshold: int = BREAKER_THRESHOLD, reset_timeout: float = BREAKER_RESET_TIMEOUT) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._trial = False
+
+    def acquire(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError("firestore is unavailable")
+
+            self.state = self.HALF_OPEN
+        
+        if self.state == self.HALF_OPEN:
+            if self._trial:
+                self.rejected += 1
+                raise CircuitOpenError("firestore is unavailable")
+
+            self._trial = True
+
+    def release(self):
+        # the call ended without telling whether firestore works, cancelled
+        self._trial = False
+
+    def record_success(self):
+        self.failures = 0
+        self._trial = False
+        if self.state != self.CLOSED:
+            self.state = self.CLOSED
+            print("[+] Firestore is back, circuit breaker closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.state = self.OPEN
+            self.times_opened += 1
+            self._opened_at = time.monotonic()
+            print(f"[~] Firestore unavailable, circuit breaker open for {self.reset_timeout:.0f}s", file=sys.stderr)
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+
+def _initialize_app():
+    # on the first client rather than on import, the memory backend has no credentials
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        with timeline.step("credentials"):
+            cred = credentials.Certificate(loads(env.GOOGLE_APPLICATION_CREDENTIALS))
+            firebase_admin.initialize_app(cred)
 
 
 def async_client(app=None):
@@ -22,18 +162,454 @@ def async_client(app=None):
       ValueError: If a project ID is not specified either via options, credentials or
           environment variables, or if the specified project ID is not a valid string.
     """
+    if env.FIRESTORE_BACKEND == "memory":
+        # offline runs, no credentials needed
+        from utils.fake_firestore import FakeClient
+
+        return FakeClient(latency=float(env.FIRESTORE_LATENCY or 0), fixture=env.FIRESTORE_FIXTURE)
+
+    if app is None:
+        _initialize_app()
+
     fs_client: _FirestoreAsyncClient = firestore._utils.get_app_service(app, firestore._FIRESTORE_ATTRIBUTE, _FirestoreAsyncClient.from_app)
     return fs_client.get()
 
 
+class DocumentCache:
+    """Bounded LRU of document snapshots that expire after the TTL of their collection
+
+    Snapshots of missing documents are cached as well, concurrent reads of
+    the same path share a single RPC, and :meth:`invalidate` is called for
+    every write made through the client. Expired snapshots are kept until
+    evicted and served while firestore is unavailable.
+    """
+    def __init__(self, ttls: dict[str, float], *, maxsize: int = CACHE_SIZE) -> None:
+        self.ttls = ttls
+        self.maxsize = maxsize
+        self._snapshots: OrderedDict[str, tuple[float, firestore.firestore.DocumentSnapshot]] = OrderedDict()
+        self._loading: dict[str, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._snapshots)
+
+    async def get(self, path: str, load: Callable[[], Awaitable]) -> firestore.firestore.DocumentSnapshot:
+        ttl = self.ttls.get(path.split("/")[-2], 0.0)
+        if ttl <= 0:
+            return await load()
+
+        snapshot = self.peek(path)
+        if snapshot is not None:
+            return snapshot
+
+        task = self._loading.get(path)
+        if task is None:
+            task = self._loading[path] = asyncio.create_task(self._load(path, load, ttl))
+
+        return await asyncio.shield(task)
+
+    def peek(self, path: str) -> Optional[firestore.firestore.DocumentSnapshot]:
+        """Returns the cached snapshot of ``path`` if it did not expire"""
+        entry = self._snapshots.get(path)
+        if entry is None:
+            return None
+
+        expires, snapshot = entry
+        if expires <= time.monotonic():
+            return None
+
+        self._snapshots.move_to_end(path)
+        return snapshot
+
+    async def _load(self, path: str, load: Callable[[], Awaitable], ttl: float):
+        task = asyncio.current_task()
+        try:
+            snapshot = await load()
+        except Exception as e:
+            stale = self._snapshots.get(path)
+            if stale is None or not is_unavailable(e):
+                raise
+
+            snapshot = stale[1]
+            ttl = 0.0
+        finally:
+            # invalidate() drops the task of a read that raced a write, its result may be stale
+            current = self._loading.get(path) is task
+            if current:
+                del self._loading[path]
+
+        if current and ttl > 0:
+            self._snapshots[path] = (time.monotonic() + ttl, snapshot)
+            self._snapshots.move_to_end(path)
+            while len(self._snapshots) > self.maxsize:
+                self._snapshots.popitem(last=False)
+
+        return snapshot
+
+    def invalidate(self, path: str):
+        self._snapshots.pop(path, None)
+        self._loading.pop(path, None)
+
+
 class AsyncDocumentReference(firestore.firestore.AsyncDocumentReference):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+
+    async def _read(self, site: str, field_paths, *args, **kwargs):
+        start = time.perf_counter()
+        doc = await self._client.call(partial(super().get, field_paths, None, *args, **kwargs))
+        nbytes = payload_size(doc.to_dict()) if doc.exists else 0
+        accounting.record("read", site, nbytes=nbytes, elapsed=time.perf_counter() - start)
+        return doc
+
+    async def get(self, field_paths=None, transaction=None, *args, **kwargs):
+        # transactional reads bypass the cache, partial reads only use it when
+        # the whole document is cached, a snapshot with extra fields is fine
+        if transaction is not None:
+            return await super().get(field_paths, transaction, *args, **kwargs)
+
+        if field_paths is not None:
+            snapshot = self._client.cache.peek(self.path)
+            if snapshot is None:
+                snapshot = await self._read(call_site(), field_paths, *args, **kwargs)
+
+            return snapshot
+
+        # the read runs in a task of the cache, the site is taken here
+        return await self._client.cache.get(self.path, partial(self._read, call_site(), None, *args, **kwargs))
     
     async def delete(self, camp=None, *args):
         if camp is not None:
             await super().update({camp: firestore.firestore.DELETE_FIELD}, *args) 
-        else: await super().delete(*args)
+        else:
+            start = time.perf_counter()
+            try:
+                await self._client.call(partial(super().delete, *args))
+            finally:
+                self._client.cache.invalidate(self.path)
+
+            accounting.record("delete", call_site(), elapsed=time.perf_counter() - start)
+
+
+class AsyncWriteBatch(firestore.firestore.AsyncWriteBatch):
+    """Write batch that invalidates the cached snapshots of the documents it writes
+
+    Document references write through a batch too, except for deletes.
+    """
+    def __init__(self, client) -> None:
+        super().__init__(client)
+        self._paths: set[str] = set()
+
+    def create(self, reference, document_data, *args, **kwargs):
+        self._paths.add(reference.path)
+        accounting.record("write", call_site(), nbytes=payload_size(document_data))
+        return super().create(reference, document_data, *args, **kwargs)
+
+    def set(self, reference, document_data, *args, **kwargs):
+        self._paths.add(reference.path)
+        accounting.record("write", call_site(), nbytes=payload_size(document_data))
+        return super().set(reference, document_data, *args, **kwargs)
+
+    def update(self, reference, field_updates, *args, **kwargs):
+        self._paths.add(reference.path)
+        accounting.record("write", call_site(), nbytes=payload_size(field_updates))
+        return super().update(reference, field_updates, *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        self._paths.add(reference.path)
+        accounting.record("delete", call_site())
+        return super().delete(reference, *args, **kwargs)
+
+    async def commit(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            # transforms like Increment are not idempotent, a single attempt
+            return await self._client.call(partial(super().commit, *args, **kwargs), idempotent=False)
+        finally:
+            # a failed commit may still have been applied
+            for path in self._paths:
+                self._client.cache.invalidate(path)
+
+            self._paths = set()
+            accounting.record("commit", call_site(), documents=0, elapsed=time.perf_counter() - start)
+
+
+class AsyncQuery(firestore.firestore.AsyncQuery):
+    """Query that records the documents it reads, see :mod:`utils.accounting`"""
+    async def stream(self, *args, **kwargs) -> AsyncIterator:
+        site = call_site()
+        start = time.perf_counter()
+        documents = 0
+        nbytes = 0
+        try:
+            async for doc in super().stream(*args, **kwargs):
+                documents += 1
+                nbytes += payload_size(doc.to_dict())
+                yield doc
+        finally:
+            # a query that matches nothing still bills one read
+            accounting.record(
+                "read", site, documents=max(documents, 1), nbytes=nbytes, elapsed=time.perf_counter() - start
+            )
+
+
+class AsyncCollectionReference(firestore.firestore.AsyncCollectionReference):
+    def _query(self) -> AsyncQuery:
+        return AsyncQuery(self)
+
+    def document(self, document_id: Optional[str] = None) -> AsyncDocumentReference:
+        doc = super().document(document_id)
+        # the cached reference, whatever the base class builds it with
+        if not isinstance(doc, AsyncDocumentReference):
+            doc = AsyncDocumentReference(*doc._path, client=self._client)
+
+        return doc
+
+
+class Subscription:
+    """Forwards the changes seen by a snapshot listener to the event loop.
+
+    ``callback(docs, changes, initial)`` is awaited for every snapshot of
+    ``path`` in order. ``initial`` is True for the first snapshot after
+    (re)subscribing, it holds the whole state of ``path`` and should replace
+    the cache instead of patching it.
+
+    With ``since``, the first snapshot only delivers the documents whose
+    update time is after it, the ones before were read with the rest of the
+    state. Firestore still sends and bills the whole first snapshot, the
+    later ones hold every change, whoever wrote it.
+    """
+    HEALTH_CHECK_INTERVAL = 30.0
+
+    def __init__(
+        self,
+        client: "AsyncClient",
+        path: str,
+        callback: Callable[[list, list, bool], Awaitable[None]],
+        *,
+        since: Optional[datetime.datetime] = None
+    ):
+        self._client = client
+        self.path = path
+        self.callback = callback
+        self.since = since
+        
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._watch = None
+        self._tasks: list[asyncio.Task] = []
+
+    def _listen(self):
+        sync_client = self._client._get_sync_client()
+        if len(self.path.split("/")) % 2 == 0:
+            target = sync_client.document(self.path)
+        else:
+            target = sync_client.collection(self.path)
+
+        first = True
+        # runs in the listener thread
+        def on_snapshot(docs, changes, read_time):
+            nonlocal first
+            initial, first = first, False
+            if initial and self.since is not None:
+                docs = [doc for doc in docs if doc.update_time > self.since]
+                changes = [change for change in changes if change.document.update_time > self.since]
+
+            self._loop.call_soon_threadsafe(self._queue.put_nowait, (docs, changes, initial))
+
+        self._watch = target.on_snapshot(on_snapshot)
+
+    async def _consume(self):
+        while True:
+            docs, changes, initial = await self._queue.get()
+            try:
+                await self.callback(docs, changes, initial)
+            except Exception:
+                print(f"In subscription to {self.path}:", file=sys.stderr)
+                traceback.print_exc()
+
+    async def _keep_alive(self):
+        # the listener retries transient errors by itself but stops on fatal ones
+        while True:
+            await asyncio.sleep(self.HEALTH_CHECK_INTERVAL)
+            if not self._watch.is_active:
+                print(f"[~] Resubscribing to {self.path}", file=sys.stderr)
+                self._watch.unsubscribe()
+                self._listen()
+
+    def start(self):
+        self._listen()
+        self._tasks = [
+            asyncio.create_task(self._consume()),
+            asyncio.create_task(self._keep_alive())
+        ]
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+        if self._watch is not None:
+            self._watch.unsubscribe()
+
+
+class Projection:
+    """Read-only view of some fields of a document
+
+    Subclasses list the fields they read in ``fields`` and parse them in
+    ``__init__``, :meth:`fetch` and :meth:`stream` only request those fields
+    so the rest of the document is not sent over the wire.
+    """
+    __slots__ = ("reference",)
+    fields: tuple[str, ...] = ()
+
+    def __init__(self, doc: firestore.firestore.DocumentSnapshot) -> None:
+        self.reference: AsyncDocumentReference = doc.reference
+
+    @classmethod
+    async def fetch(cls, reference: AsyncDocumentReference):
+        """Returns the projection of the document, None if it does not exist"""
+        doc = await reference.get(field_paths=cls.fields)
+        return cls(doc) if doc.exists else None
+
+    @classmethod
+    async def stream(cls, query) -> AsyncIterator:
+        async for doc in query.select(cls.fields).stream():
+            yield cls(doc)
+
+
+class _AsyncBulkWriteBatch(BulkWriteBatch):
+    async def commit(self, retry=gapic_v1.method.DEFAULT, timeout: Optional[float] = None):
+        request, kwargs = self._prep_commit(retry, timeout)
+        response = await self._client._firestore_api.batch_write(
+            request=request,
+            metadata=self._client._rpc_metadata,
+            **kwargs
+        )
+
+        self._write_pbs = []
+        self.write_results = list(response.write_results)
+        return response
+
+
+class BulkWriteError(Exception):
+    def __init__(self, failures: list[tuple[str, object]]) -> None:
+        self.failures = failures
+        super().__init__(f"{len(failures)} writes failed, first: {failures[0][0]}: {failures[0][1]}")
+
+
+class BulkWriter:
+    """Queues writes and sends them in non atomic BatchWrite RPCs
+
+    A batch is sent when it holds ``batch_size`` writes, ``flush_interval``
+    seconds after its first write, or on :meth:`flush`, with at most
+    ``concurrency`` RPCs in flight. A document is written at most once per
+    batch, a second write starts a new batch that waits for the first one.
+
+    Failed writes are collected in ``failures`` as ``(path, error)``, where
+    the error is the status of the write or the exception of its RPC.
+    Leaving ``async with client.bulk_writer()`` raises :class:`BulkWriteError`
+    if any write failed.
+    """
+    def __init__(
+        self,
+        client: "AsyncClient",
+        *,
+        batch_size: int = BULK_BATCH_SIZE,
+        concurrency: int = BULK_CONCURRENCY,
+        flush_interval: float = BULK_FLUSH_INTERVAL
+    ) -> None:
+        self._client = client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.failures: list[tuple[str, object]] = []
+
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._batch = _AsyncBulkWriteBatch(client)
+        # paths written by the queued batch, in order
+        self._paths: dict[str, None] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # path: task of the last batch in flight that writes it
+        self._writing: dict[str, asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def _add(self, reference, write: Callable, operation: str = "write", data: Optional[dict] = None):
+        accounting.record(operation, call_site(), nbytes=payload_size(data) if data is not None else 0)
+        if reference.path in self._paths:
+            self._send()
+
+        write(self._batch)
+        self._paths[reference.path] = None
+        if len(self._paths) >= self.batch_size:
+            self._send()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._send)
+
+    def create(self, reference, document_data: dict):
+        self._add(reference, lambda batch: batch.create(reference, document_data), data=document_data)
+
+    def set(self, reference, document_data: dict, merge=False):
+        self._add(reference, lambda batch: batch.set(reference, document_data, merge=merge), data=document_data)
+
+    def update(self, reference, field_updates: dict):
+        self._add(reference, lambda batch: batch.update(reference, field_updates), data=field_updates)
+
+    def delete(self, reference):
+        self._add(reference, lambda batch: batch.delete(reference), "delete")
+
+    def _send(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._paths:
+            return
+
+        batch, paths = self._batch, self._paths
+        self._batch, self._paths = _AsyncBulkWriteBatch(self._client), {}
+
+        waits = {self._writing[path] for path in paths if path in self._writing}
+        task = asyncio.create_task(self._commit(batch, paths, waits))
+        for path in paths:
+            self._writing[path] = task
+
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _commit(self, batch: _AsyncBulkWriteBatch, paths: dict[str, None], waits: "set[asyncio.Task]"):
+        if waits:
+            # earlier writes of the same documents go first
+            await asyncio.wait(waits)
+
+        try:
+            async with self._semaphore:
+                start = time.perf_counter()
+                response = await self._client.call(batch.commit, idempotent=False)
+                accounting.record("commit", call_site(), documents=0, elapsed=time.perf_counter() - start)
+        except Exception as e:
+            self.failures.extend((path, e) for path in paths)
+        else:
+            self.failures.extend(
+                (path, status) for path, status in zip(paths, response.status) if status.code != 0
+            )
+        finally:
+            task = asyncio.current_task()
+            for path in paths:
+                self._client.cache.invalidate(path)
+                if self._writing.get(path) is task:
+                    del self._writing[path]
+
+    async def flush(self):
+        """Sends the queued writes and waits for every batch in flight"""
+        self._send()
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    async def __aenter__(self) -> "BulkWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.flush()
+        if exc_type is None and self.failures:
+            raise BulkWriteError(self.failures)
 
 
 class AsyncClient(firestore.firestore.AsyncClient):
@@ -44,13 +620,116 @@ class AsyncClient(firestore.firestore.AsyncClient):
         self.ArrayUnion = firestore.firestore.ArrayUnion
         self.ArrayRemove = firestore.firestore.ArrayRemove
         self.Increment = firestore.firestore.Increment
+        self.DELETE_FIELD = firestore.firestore.DELETE_FIELD
         self.Query = firestore.firestore.AsyncQuery
+        self.ChangeType = ChangeType
+        self.cache = DocumentCache(CACHE_TTLS)
+        self.breaker = CircuitBreaker()
+        self._sync_client = None
+
+    async def call(self, operation: Callable[[], Awaitable], *, idempotent: bool = True, deadline: float = CALL_DEADLINE):
+        """Awaits ``operation()`` within ``deadline`` seconds through the circuit breaker
+
+        Transient failures of ``idempotent`` operations are retried with
+        exponential backoff and full jitter.
+        """
+        attempts = RETRY_ATTEMPTS if idempotent else 1
+        for attempt in range(attempts):
+            self.breaker.acquire()
+            try:
+                result = await asyncio.wait_for(operation(), deadline)
+            except TRANSIENT_ERRORS:
+                self.breaker.record_failure()
+                if attempt + 1 == attempts:
+                    raise
+            except exceptions.GoogleAPICallError:
+                # firestore answered, the request was wrong
+                self.breaker.record_success()
+                raise
+            except BaseException:
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+            await asyncio.sleep(random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt))
+
+    async def _get_all(self, references: list, *args, **kwargs) -> list:
+        docs = super().get_all(references, *args, **kwargs)
+        return [doc async for doc in docs]
+
+    async def get_all(self, references: Iterable, *args, **kwargs) -> AsyncIterator:
+        site = call_site()
+        start = time.perf_counter()
+        # read in one go so the whole call can be retried
+        docs = await self.call(partial(self._get_all, list(references), *args, **kwargs))
+        accounting.record(
+            "read",
+            site,
+            documents=len(docs),
+            nbytes=sum(payload_size(doc.to_dict()) for doc in docs if doc.exists),
+            elapsed=time.perf_counter() - start
+        )
+        
+        for doc in docs:
+            yield doc
+
+    def collection(self, *collection_path: str) -> AsyncCollectionReference:
+        return AsyncCollectionReference(*collection_path, client=self)
+
+    def _get_sync_client(self) -> firestore.firestore.Client:
+        # snapshot listeners only exist on the sync client
+        if self._sync_client is None:
+            self._sync_client = firestore.firestore.Client(credentials=self._credentials, project=self.project)
+
+        return self._sync_client
+
+    def subscribe(
+        self,
+        path: str,
+        callback: Callable[[list, list, bool], Awaitable[None]],
+        *,
+        since: Optional[datetime.datetime] = None
+    ) -> Subscription:
+        """Listens to the document or collection at ``path``, see :class:`Subscription`"""
+        subscription = Subscription(self, path, callback, since=since)
+        subscription.start()
+        return subscription
     
     def document(self, *document_path: str) -> AsyncDocumentReference:
         return AsyncDocumentReference(
             *self._document_path_helper(*document_path), client=self
         )
 
+    def batch(self) -> AsyncWriteBatch:
+        return AsyncWriteBatch(self)
+
+    def bulk_writer(self, **options) -> BulkWriter:
+        """Returns a :class:`BulkWriter`, ``options`` are passed to it"""
+        return BulkWriter(self, **options)
+
+    async def paginate(self, query, *, page_size: int = DEFAULT_PAGE_SIZE) -> AsyncIterator[list]:
+        """Yields the snapshots of ``query`` in pages of ``page_size`` documents.
+
+        Every page is a single RPC that resumes from the last snapshot of the
+        previous one, so the query must have a stable order (document name).
+        """
+        cursor = None
+        while True:
+            page_query = query.limit(page_size)
+            if cursor is not None:
+                page_query = page_query.start_after(cursor)
+
+            page = [doc async for doc in page_query.stream()]
+            if page:
+                yield page
+
+            if len(page) < page_size:
+                return
+
+            cursor = page[-1]
+
 
 class _FirestoreAsyncClient:
     """Holds a async Google Cloud Firestore client instance."""
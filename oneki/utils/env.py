@@ -11,3 +11,15 @@ GOOGLE_APPLICATION_CREDENTIALS = getenv("GOOGLE_APPLICATION_CREDENTIALS")
 
 PORT = getenv("PORT")
 DEBUG_CHANNEL = getenv("DEBUG_CHANNEL")
+CACHE_PROFILE = getenv("CACHE_PROFILE")
+FORCE_SYNC = getenv("FORCE_SYNC")
+SNAPSHOT_PATH = getenv("SNAPSHOT_PATH")
+OUTBOX_PATH = getenv("OUTBOX_PATH")
+FIRESTORE_BACKEND = getenv("FIRESTORE_BACKEND")
+FIRESTORE_LATENCY = getenv("FIRESTORE_LATENCY")
+FIRESTORE_FIXTURE = getenv("FIRESTORE_FIXTURE")
+
+# sharded mode, see launcher
+SHARD_COUNT = getenv("SHARD_COUNT")
+SHARD_PROCESSES = getenv("SHARD_PROCESSES")
+IPC_PORT = getenv("IPC_PORT")
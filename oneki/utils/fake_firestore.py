@@ -0,0 +1,684 @@
+from google.api_core import exceptions
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1._helpers import LastUpdateOption
+from google.cloud.firestore_v1.base_client import BaseClient
+from google.cloud.firestore_v1.field_path import parse_field_path
+from google.cloud.firestore_v1.watch import ChangeType
+from functools import cmp_to_key
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Optional, Union
+
+import asyncio
+import copy
+import datetime
+import json
+import random
+import string
+import sys
+import time
+import traceback
+
+from utils.accounting import accounting, call_site
+from utils.db import AsyncClient, CircuitBreaker, DocumentCache
+
+
+_MISSING = object()
+_ID_CHARACTERS = string.ascii_letters + string.digits
+
+
+def _split(field_path: str) -> list[str]:
+    # same rules as the real client, segments that are not identifiers need backticks
+    return parse_field_path(field_path)
+
+
+def _get_field(data: dict, field_path: str) -> Any:
+    value = data
+    for key in _split(field_path):
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+
+        value = value[key]
+
+    return value
+
+
+def _type_rank(value: Any) -> int:
+    # firestore orders values of different types by type first
+    if value is None:
+        return 0
+    elif isinstance(value, bool):
+        return 1
+    elif isinstance(value, (int, float)):
+        return 2
+    elif isinstance(value, datetime.datetime):
+        return 3
+    elif isinstance(value, str):
+        return 4
+    elif isinstance(value, bytes):
+        return 5
+    elif isinstance(value, list):
+        return 6
+
+    return 7
+
+
+def _compare(a: Any, b: Any) -> int:
+    rank_a, rank_b = _type_rank(a), _type_rank(b)
+    if rank_a != rank_b:
+        return -1 if rank_a < rank_b else 1
+
+    if rank_a == 0:
+        return 0
+
+    if rank_a == 7:
+        a, b = json.dumps(a, sort_keys=True, default=str), json.dumps(b, sort_keys=True, default=str)
+
+    return (a > b) - (a < b)
+
+
+def _resolve(value: Any, current: Any = _MISSING) -> Any:
+    """Returns the stored value of a field written with ``value``, transforms applied on ``current``"""
+    if value is transforms.SERVER_TIMESTAMP:
+        return _now()
+    elif isinstance(value, transforms.Increment):
+        base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+        return base + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        values = list(current) if isinstance(current, list) else []
+        values.extend(v for v in value.values if v not in values)
+        return values
+    elif isinstance(value, transforms.ArrayRemove):
+        if not isinstance(current, list):
+            return []
+
+        return [v for v in current if v not in value.values]
+    elif isinstance(value, dict):
+        return {key: _resolve(v) for key, v in value.items() if v is not transforms.DELETE_FIELD}
+    elif isinstance(value, (list, tuple)):
+        return [_resolve(v) for v in value]
+
+    return value
+
+
+def _write_field(data: dict, path: list[str], value: Any):
+    parent = data
+    for key in path[:-1]:
+        child = parent.get(key)
+        if not isinstance(child, dict):
+            child = parent[key] = {}
+
+        parent = child
+
+    if value is transforms.DELETE_FIELD:
+        parent.pop(path[-1], None)
+    else:
+        parent[path[-1]] = _resolve(value, parent.get(path[-1], _MISSING))
+
+
+def _leaves(data: dict, prefix: tuple = ()) -> Iterable[tuple[list[str], Any]]:
+    # what set(merge=True) writes, nested maps are merged instead of replaced
+    for key, value in data.items():
+        if isinstance(value, dict) and value:
+            yield from _leaves(value, (*prefix, key))
+        else:
+            yield [*prefix, key], value
+
+
+def _project(data: dict, field_paths: Iterable[str]) -> dict:
+    projected = {}
+    for field_path in field_paths:
+        value = _get_field(data, field_path)
+        if value is not _MISSING:
+            _write_field(projected, _split(field_path), copy.deepcopy(value))
+
+    return projected
+
+
+_last_time = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+
+def _now() -> DatetimeWithNanoseconds:
+    # strictly increasing, revisions of a document must differ, see db.version
+    global _last_time
+    now = datetime.datetime.now(datetime.timezone.utc)
+    if now <= _last_time:
+        now = _last_time + datetime.timedelta(microseconds=1)
+
+    _last_time = now
+    return DatetimeWithNanoseconds(
+        now.year, now.month, now.day, now.hour, now.minute, now.second, now.microsecond, tzinfo=now.tzinfo
+    )
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference: "FakeDocumentReference", data: Optional[dict], update_time=None) -> None:
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time
+        self.read_time = _now()
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    def to_dict(self) -> Optional[dict]:
+        return copy.deepcopy(self._data)
+
+    def get(self, field_path: str) -> Any:
+        value = _get_field(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+
+        return copy.deepcopy(value)
+
+
+class FakeChange:
+    __slots__ = ("type", "document")
+
+    def __init__(self, type: ChangeType, document: FakeDocumentSnapshot) -> None:
+        self.type = type
+        self.document = document
+
+
+class FakeWriteResult:
+    __slots__ = ("update_time",)
+
+    def __init__(self, update_time) -> None:
+        self.update_time = update_time
+
+
+class FakeDocumentReference:
+    def __init__(self, client: "FakeClient", path: str) -> None:
+        self._client = client
+        self.path = path
+
+    def __repr__(self) -> str:
+        return f"<FakeDocumentReference path={self.path!r}>"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self) -> int:
+        return hash(self.path)
+
+    @property
+    def id(self) -> str:
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, collection_id: str) -> "FakeCollectionReference":
+        return FakeCollectionReference(self._client, f"{self.path}/{collection_id}")
+
+    async def get(self, field_paths: Optional[Iterable[str]] = None, transaction=None, *args, **kwargs) -> FakeDocumentSnapshot:
+        site = call_site()
+        await self._client._delay()
+        snapshot = self._client._snapshot(self.path, field_paths)
+        accounting.record("read", site)
+        return snapshot
+
+    async def _write(self, method: str, *args, **kwargs) -> FakeWriteResult:
+        batch = self._client.batch()
+        getattr(batch, method)(self, *args, **kwargs)
+        results = await batch.commit()
+        return results[0]
+
+    async def create(self, document_data: dict) -> FakeWriteResult:
+        return await self._write("create", document_data)
+
+    async def set(self, document_data: dict, merge: Union[bool, list[str]] = False) -> FakeWriteResult:
+        return await self._write("set", document_data, merge=merge)
+
+    async def update(self, field_updates: dict, option=None) -> FakeWriteResult:
+        return await self._write("update", field_updates, option=option)
+
+    async def delete(self, camp=None, *args):
+        if camp is not None:
+            await self.update({camp: transforms.DELETE_FIELD})
+        else:
+            await self._write("delete")
+
+
+class FakeQuery:
+    """Query over the documents of a collection, or of every collection with the same id"""
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(
+        self,
+        client: "FakeClient",
+        path: str,
+        *,
+        filters: tuple = (),
+        orders: tuple = (),
+        limit: Optional[int] = None,
+        start_after: Optional[FakeDocumentSnapshot] = None,
+        projection: Optional[tuple[str, ...]] = None
+    ) -> None:
+        self._client = client
+        self._path = path
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._start_after = start_after
+        self._projection = projection
+
+    def _copy(self, **changes) -> "FakeQuery":
+        options = {
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "start_after": self._start_after,
+            "projection": self._projection
+        }
+        options.update(changes)
+        return FakeQuery(self._client, self._path, **options)
+
+    def where(self, field_path: str, op_string: str, value: Any) -> "FakeQuery":
+        return self._copy(filters=(*self._filters, (field_path, op_string, value)))
+
+    def order_by(self, field_path: str, direction: str = ASCENDING) -> "FakeQuery":
+        return self._copy(orders=(*self._orders, (field_path, direction)))
+
+    def limit(self, count: int) -> "FakeQuery":
+        return self._copy(limit=count)
+
+    def start_after(self, snapshot: FakeDocumentSnapshot) -> "FakeQuery":
+        return self._copy(start_after=snapshot)
+
+    def select(self, field_paths: Iterable[str]) -> "FakeQuery":
+        return self._copy(projection=tuple(field_paths))
+
+    def _matches(self, path: str, data: dict) -> bool:
+        parent, _ = path.rsplit("/", 1)
+        if parent != self._path:
+            return False
+
+        for field_path, op, value in self._filters:
+            field = _get_field(data, field_path)
+            if field is _MISSING:
+                return False
+
+            if op == "==":
+                ok = _compare(field, value) == 0
+            elif op == "!=":
+                ok = _compare(field, value) != 0
+            elif op == "<":
+                ok = _compare(field, value) < 0
+            elif op == "<=":
+                ok = _compare(field, value) <= 0
+            elif op == ">":
+                ok = _compare(field, value) > 0
+            elif op == ">=":
+                ok = _compare(field, value) >= 0
+            elif op == "in":
+                ok = any(_compare(field, v) == 0 for v in value)
+            elif op == "not-in":
+                ok = all(_compare(field, v) != 0 for v in value)
+            elif op == "array-contains":
+                ok = isinstance(field, list) and value in field
+            elif op == "array-contains-any":
+                ok = isinstance(field, list) and any(v in field for v in value)
+            else:
+                raise ValueError(f"unsupported operator {op!r}")
+
+            if not ok:
+                return False
+
+        # documents without an ordered field are left out, like in firestore
+        return all(_get_field(data, field_path) is not _MISSING for field_path, _ in self._orders)
+
+    def _order(self, a: tuple[str, dict], b: tuple[str, dict]) -> int:
+        for field_path, direction in self._orders:
+            result = _compare(_get_field(a[1], field_path), _get_field(b[1], field_path))
+            if result:
+                return -result if direction == self.DESCENDING else result
+
+        return (a[0] > b[0]) - (a[0] < b[0])
+
+    def _run(self) -> list[FakeDocumentSnapshot]:
+        docs = sorted(
+            ((path, data) for path, data in self._client._docs.items() if self._matches(path, data)),
+            key=cmp_to_key(self._order)
+        )
+
+        if self._start_after is not None:
+            cursor = (self._start_after.reference.path, self._start_after._data or {})
+            docs = [doc for doc in docs if self._order(doc, cursor) > 0]
+
+        if self._limit is not None:
+            docs = docs[:self._limit]
+
+        return [self._client._snapshot(path, self._projection) for path, _ in docs]
+
+    async def stream(self, *args, **kwargs) -> AsyncIterator[FakeDocumentSnapshot]:
+        site = call_site()
+        await self._client._delay()
+        snapshots = self._run()
+        accounting.record("read", site, documents=max(len(snapshots), 1))
+        for snapshot in snapshots:
+            yield snapshot
+
+    async def get(self, *args, **kwargs) -> list[FakeDocumentSnapshot]:
+        return [snapshot async for snapshot in self.stream()]
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client: "FakeClient", path: str) -> None:
+        super().__init__(client, path)
+
+    @property
+    def id(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def parent(self) -> Optional[FakeDocumentReference]:
+        """The document holding this subcollection, None for a root collection"""
+        if "/" not in self._path:
+            return None
+
+        return FakeDocumentReference(self._client, self._path.rsplit("/", 1)[0])
+
+    def document(self, document_id: Optional[str] = None) -> FakeDocumentReference:
+        if document_id is None:
+            document_id = "".join(self._client._random.choices(_ID_CHARACTERS, k=20))
+
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id}")
+
+    async def add(self, document_data: dict) -> tuple[Any, FakeDocumentReference]:
+        reference = self.document()
+        await reference.create(document_data)
+        return self._client._times[reference.path], reference
+
+    async def list_documents(self, page_size: Optional[int] = None) -> AsyncIterator[FakeDocumentReference]:
+        await self._client._delay()
+        prefix = f"{self._path}/"
+        paths = sorted(path for path in self._client._docs if path.startswith(prefix) and "/" not in path[len(prefix):])
+        for path in paths:
+            yield FakeDocumentReference(self._client, path)
+
+
+class FakeWriteBatch:
+    """Applies its writes atomically on commit, like a firestore batch"""
+    def __init__(self, client: "FakeClient") -> None:
+        self._client = client
+        self._writes: list[tuple] = []
+
+    def __len__(self) -> int:
+        return len(self._writes)
+
+    def create(self, reference: FakeDocumentReference, document_data: dict):
+        self._writes.append(("create", reference.path, document_data, False, None))
+        accounting.record("write", call_site())
+
+    def set(self, reference: FakeDocumentReference, document_data: dict, merge: Union[bool, list[str]] = False):
+        if not isinstance(merge, bool):
+            # like the real client, every merged field must be in the data
+            for field_path in merge:
+                if _get_field(document_data, field_path) is _MISSING:
+                    raise ValueError(f"Merge field {field_path} is not in the document data")
+
+        self._writes.append(("set", reference.path, document_data, merge, None))
+        accounting.record("write", call_site())
+
+    def update(self, reference: FakeDocumentReference, field_updates: dict, option=None):
+        self._writes.append(("update", reference.path, field_updates, False, option))
+        accounting.record("write", call_site())
+
+    def delete(self, reference: FakeDocumentReference, option=None):
+        self._writes.append(("delete", reference.path, None, False, option))
+        accounting.record("delete", call_site())
+
+    async def commit(self, *args, **kwargs) -> list[FakeWriteResult]:
+        start = time.perf_counter()
+        await self._client._delay()
+        writes, self._writes = self._writes, []
+        try:
+            return self._client._apply(writes)
+        finally:
+            accounting.record("commit", call_site(), documents=0, elapsed=time.perf_counter() - start)
+
+    async def __aenter__(self) -> "FakeWriteBatch":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.commit()
+
+
+class FakeBulkWriter:
+    """Same interface as :class:`db.BulkWriter`, every write is applied on its own"""
+    def __init__(self, client: "FakeClient", **options) -> None:
+        self._client = client
+        self._writes: list[tuple] = []
+        self.failures: list[tuple[str, object]] = []
+
+    def create(self, reference, document_data: dict):
+        self._writes.append(("create", reference.path, document_data, False, None))
+
+    def set(self, reference, document_data: dict, merge=False):
+        self._writes.append(("set", reference.path, document_data, merge, None))
+
+    def update(self, reference, field_updates: dict, option=None):
+        self._writes.append(("update", reference.path, field_updates, False, option))
+
+    def delete(self, reference, option=None):
+        self._writes.append(("delete", reference.path, None, False, option))
+
+    async def flush(self):
+        await self._client._delay()
+        writes, self._writes = self._writes, []
+        for write in writes:
+            try:
+                self._client._apply([write])
+            except exceptions.GoogleAPICallError as e:
+                self.failures.append((write[1], e))
+
+    async def __aenter__(self) -> "FakeBulkWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        from utils.db import BulkWriteError
+
+        await self.flush()
+        if exc_type is None and self.failures:
+            raise BulkWriteError(self.failures)
+
+
+class FakeSubscription:
+    def __init__(
+        self,
+        client: "FakeClient",
+        path: str,
+        callback: Callable[[list, list, bool], Awaitable[None]],
+        *,
+        since: Optional[datetime.datetime] = None
+    ) -> None:
+        self._client = client
+        self.path = path
+        self.callback = callback
+        self.since = since
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+
+    def _is_document(self) -> bool:
+        return len(self.path.split("/")) % 2 == 0
+
+    def _docs(self) -> list[FakeDocumentSnapshot]:
+        if self._is_document():
+            return [self._client._snapshot(self.path)]
+
+        return FakeQuery(self._client, self.path)._run()
+
+    def _notify(self, path: str, change_type: ChangeType):
+        if path == self.path or (not self._is_document() and path.rsplit("/", 1)[0] == self.path):
+            change = FakeChange(change_type, self._client._snapshot(path))
+            self._queue.put_nowait((self._docs(), [change], False))
+
+    async def _consume(self):
+        while True:
+            docs, changes, initial = await self._queue.get()
+            try:
+                await self.callback(docs, changes, initial)
+            except Exception:
+                print(f"In subscription to {self.path}:", file=sys.stderr)
+                traceback.print_exc()
+
+    def start(self):
+        docs = self._docs()
+        if self.since is not None:
+            docs = [doc for doc in docs if doc.exists and doc.update_time > self.since]
+
+        changes = [FakeChange(ChangeType.ADDED, doc) for doc in docs if doc.exists]
+        self._queue.put_nowait((docs, changes, True))
+        self._client._subscriptions.add(self)
+        self._task = asyncio.create_task(self._consume())
+
+    def close(self):
+        self._client._subscriptions.discard(self)
+        if self._task is not None:
+            self._task.cancel()
+
+
+class FakeClient:
+    """In-memory stand-in of :class:`db.AsyncClient`, for offline runs and benchmarks
+
+    Implements the part of the client the bot uses, with documents kept in a
+    dict of path to data. Every call that would be an RPC waits ``latency``
+    seconds, and generated ids come from a seeded generator so runs are
+    reproducible. ``fixture`` is a JSON file of path to data loaded first.
+    """
+    ArrayUnion = transforms.ArrayUnion
+    ArrayRemove = transforms.ArrayRemove
+    Increment = transforms.Increment
+    DELETE_FIELD = transforms.DELETE_FIELD
+    Query = FakeQuery
+    ChangeType = ChangeType
+    write_option = staticmethod(BaseClient.write_option)
+    field_path = staticmethod(BaseClient.field_path)
+
+    # the pager only uses the query surface above
+    paginate = AsyncClient.paginate
+
+    def __init__(self, *, latency: float = 0.0, fixture: Optional[str] = None, seed: int = 0) -> None:
+        self.latency = latency
+        self._random = random.Random(seed)
+        self._docs: dict[str, dict] = {}
+        self._times: dict[str, DatetimeWithNanoseconds] = {}
+        self._subscriptions: set[FakeSubscription] = set()
+
+        # nothing is cached or failing, they keep the interface of the real client
+        self.cache = DocumentCache({})
+        self.breaker = CircuitBreaker()
+
+        if fixture is not None:
+            with open(fixture) as f:
+                for path, data in json.load(f).items():
+                    self._docs[path] = data
+                    self._times[path] = _now()
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _snapshot(self, path: str, field_paths: Optional[Iterable[str]] = None) -> FakeDocumentSnapshot:
+        data = self._docs.get(path)
+        if data is not None:
+            data = _project(data, field_paths) if field_paths is not None else copy.deepcopy(data)
+
+        return FakeDocumentSnapshot(FakeDocumentReference(self, path), data, self._times.get(path))
+
+    def _apply(self, writes: list[tuple]) -> list[FakeWriteResult]:
+        # on copies first, a failed write leaves every document untouched
+        docs = {}
+        for op, path, data, merge, option in writes:
+            current = docs[path] if path in docs else copy.deepcopy(self._docs.get(path))
+            if isinstance(option, LastUpdateOption) and self._times.get(path) != option._last_update_time:
+                raise exceptions.FailedPrecondition(f"Document changed since it was read: {path}")
+            elif op == "create" and current is not None:
+                raise exceptions.AlreadyExists(f"Document already exists: {path}")
+            elif op == "update" and current is None:
+                raise exceptions.NotFound(f"No document to update: {path}")
+
+            if op == "delete":
+                docs[path] = None
+                continue
+
+            if op in ("create", "update") or merge:
+                document = current if current is not None else {}
+                if op != "set":
+                    fields = ((_split(key), value) for key, value in data.items())
+                elif merge is True:
+                    fields = _leaves(data)
+                else:
+                    # only the listed fields, each replaced as a whole
+                    fields = ((_split(field_path), _get_field(data, field_path)) for field_path in merge)
+                for field_path, value in fields:
+                    _write_field(document, field_path, value)
+            else:
+                document = _resolve(data)
+
+            docs[path] = document
+
+        for path, document in docs.items():
+            existed = path in self._docs
+            if document is None:
+                if not existed:
+                    continue
+
+                del self._docs[path]
+                self._times.pop(path, None)
+                change_type = ChangeType.REMOVED
+            else:
+                self._docs[path] = document
+                self._times[path] = _now()
+                change_type = ChangeType.MODIFIED if existed else ChangeType.ADDED
+
+            for subscription in list(self._subscriptions):
+                subscription._notify(path, change_type)
+
+        return [FakeWriteResult(self._times.get(path)) for _, path, *_ in writes]
+
+    def document(self, *document_path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, "/".join(document_path))
+
+    def collection(self, *collection_path: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, "/".join(collection_path))
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def bulk_writer(self, **options) -> FakeBulkWriter:
+        return FakeBulkWriter(self, **options)
+
+    async def call(self, operation: Callable[[], Awaitable], **options):
+        return await operation()
+
+    async def get_all(self, references: Iterable, field_paths: Optional[Iterable[str]] = None, *args, **kwargs) -> AsyncIterator:
+        site = call_site()
+        references = list(references)
+        await self._delay()
+        accounting.record("read", site, documents=len(references))
+        for reference in references:
+            yield self._snapshot(reference.path, field_paths)
+
+    def subscribe(
+        self,
+        path: str,
+        callback: Callable[[list, list, bool], Awaitable[None]],
+        *,
+        since: Optional[datetime.datetime] = None
+    ) -> FakeSubscription:
+        subscription = FakeSubscription(self, path, callback, since=since)
+        subscription.start()
+        return subscription
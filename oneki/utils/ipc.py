@@ -0,0 +1,80 @@
+from typing import Any, Callable, Optional
+
+import asyncio
+import json
+import sys
+
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 7650
+
+
+class Broker:
+    """Relays every message published by a worker to the other workers
+
+    Runs in the launcher process, workers connect with :func:`connect`.
+    Messages are JSON lines ``{"event": str, "data": Any, "origin": int}``.
+    """
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        self.host = host
+        self.port = port
+        self._writers: set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            async for line in reader:
+                for other in self._writers:
+                    if other is not writer:
+                        other.write(line)
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+class Client:
+    """Connection of a worker to the :class:`Broker`
+
+    Every received message is passed to ``dispatch`` as
+    ``dispatch(f"ipc_{event}", data, origin)``, which on the bot turns it
+    into an ``on_ipc_<event>`` event.
+    """
+    def __init__(self, worker_id: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, dispatch: Callable) -> None:
+        self.worker_id = worker_id
+        self._reader = reader
+        self._writer = writer
+        self._dispatch = dispatch
+        self._task = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        async for line in self._reader:
+            try:
+                message = json.loads(line)
+            except ValueError:
+                print(f"[~] Invalid IPC message: {line!r}", file=sys.stderr)
+                continue
+
+            self._dispatch(f"ipc_{message['event']}", message["data"], message["origin"])
+
+    def publish(self, event: str, data: Any = None):
+        message = {"event": event, "data": data, "origin": self.worker_id}
+        self._writer.write(json.dumps(message).encode() + b"\n")
+
+    async def close(self):
+        self._task.cancel()
+        self._writer.close()
+        await self._writer.wait_closed()
+
+
+async def connect(worker_id: int, dispatch: Callable, *, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> Client:
+    reader, writer = await asyncio.open_connection(host, port)
+    return Client(worker_id, reader, writer, dispatch)
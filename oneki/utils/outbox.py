@@ -0,0 +1,223 @@
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+from typing import Any, Optional, TYPE_CHECKING
+
+import asyncio
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import traceback
+
+from .accounting import accounting, call_site, payload_size
+
+if TYPE_CHECKING:
+    from .db import AsyncClient
+
+
+DEFAULT_PATH = os.path.join(".cache", "outbox.sqlite3")
+# writes per commit, firestore limit
+BATCH_SIZE = 500
+# seconds between two attempts while firestore is unavailable
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+# seconds close waits for the last drain, heroku kills a dyno 30 seconds after its SIGTERM
+CLOSE_TIMEOUT = 20.0
+
+
+def encode(value: Any) -> Any:
+    """Turns the transforms and datetimes of a write into JSON values"""
+    if isinstance(value, dict):
+        return {key: encode(v) for key, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [encode(v) for v in value]
+    elif value is transforms.DELETE_FIELD:
+        return {"$delete": True}
+    elif value is transforms.SERVER_TIMESTAMP:
+        return {"$server_timestamp": True}
+    elif isinstance(value, transforms.Increment):
+        return {"$increment": value.value}
+    elif isinstance(value, transforms.ArrayUnion):
+        return {"$array_union": encode(value.values)}
+    elif isinstance(value, transforms.ArrayRemove):
+        return {"$array_remove": encode(value.values)}
+    elif isinstance(value, datetime.datetime):
+        return {"$datetime": value.isoformat()}
+
+    return value
+
+
+def decode(value: Any) -> Any:
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    elif not isinstance(value, dict):
+        return value
+
+    if len(value) == 1:
+        key, v = next(iter(value.items()))
+        if key == "$delete":
+            return transforms.DELETE_FIELD
+        elif key == "$server_timestamp":
+            return transforms.SERVER_TIMESTAMP
+        elif key == "$increment":
+            return transforms.Increment(v)
+        elif key == "$array_union":
+            return transforms.ArrayUnion(decode(v))
+        elif key == "$array_remove":
+            return transforms.ArrayRemove(decode(v))
+        elif key == "$datetime":
+            return datetime.datetime.fromisoformat(v)
+
+    return {key: decode(v) for key, v in value.items()}
+
+
+def is_permanent(error: Exception) -> bool:
+    """Whether retrying the writes that raised ``error`` can not succeed"""
+    return isinstance(error, exceptions.ClientError) and not isinstance(
+        error, (exceptions.Aborted, exceptions.TooManyRequests)
+    )
+
+
+class Outbox:
+    """Local append-only log of Firestore writes drained in the background
+
+    :meth:`set`, :meth:`update` and :meth:`delete` store the write in a
+    SQLite file and return right away, a task commits the pending writes in
+    order in batches of :data:`BATCH_SIZE` and removes them from the file.
+    Writes left by a crash are sent when the outbox starts again, a batch
+    interrupted while committing is sent again (at least once delivery).
+
+    While Firestore is unavailable the drain is retried with backoff. A batch
+    rejected for good is split to find the writes at fault, which are logged
+    and dropped.
+
+    The file only outlives restarts that keep the disk. On heroku it is lost
+    with the dyno, so :meth:`close`, run on SIGTERM, sends the pending writes
+    before the process exits.
+    """
+    def __init__(self, db: "AsyncClient", path: str = DEFAULT_PATH) -> None:
+        self._db = db
+        self.path = path
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # WAL without fsync on commit survives a crash of the process, not of the host
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS writes ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, path TEXT NOT NULL, data TEXT, merge INTEGER)"
+        )
+        self._conn.commit()
+
+        self._pending = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM writes").fetchone()[0]
+
+    def _append(self, op: str, path: str, data: Optional[dict] = None, merge: bool = False, site: Optional[str] = None):
+        # billed later to the drain, this keeps the site that queued them
+        accounting.record("queued", site or call_site(), nbytes=payload_size(data) if data is not None else 0)
+        self._conn.execute(
+            "INSERT INTO writes (op, path, data, merge) VALUES (?, ?, ?, ?)",
+            (op, path, None if data is None else json.dumps(encode(data)), int(merge))
+        )
+        self._conn.commit()
+        self._pending.set()
+
+    def set(self, path: str, data: dict, *, merge: bool = False, site: Optional[str] = None):
+        """``site`` is the call site the write is accounted to, the caller by default"""
+        self._append("set", path, data, merge, site)
+
+    def update(self, path: str, data: dict):
+        self._append("update", path, data)
+
+    def delete(self, path: str):
+        self._append("delete", path)
+
+    def start(self):
+        self._pending.set()
+        self._task = asyncio.create_task(self._drain())
+
+    async def close(self):
+        """Stops the drain after a last attempt, what is left is sent on the next start"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+        try:
+            await asyncio.wait_for(self._flush(), CLOSE_TIMEOUT)
+        except Exception:
+            print(f"[~] Outbox: {len(self)} writes left for the next start", file=sys.stderr)
+
+        self._conn.close()
+
+    async def _drain(self):
+        delay = RETRY_DELAY
+        while True:
+            await self._pending.wait()
+            try:
+                await self._flush()
+            except Exception as e:
+                print(f"[~] Outbox: drain failed ({type(e).__name__}: {e}), retrying in {delay:.0f}s", file=sys.stderr)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                self._pending.set()
+            else:
+                delay = RETRY_DELAY
+
+    async def _flush(self):
+        while True:
+            # cleared before reading, a write appended meanwhile sets it again
+            self._pending.clear()
+            rows = self._conn.execute(
+                "SELECT id, op, path, data, merge FROM writes ORDER BY id LIMIT ?", (BATCH_SIZE,)
+            ).fetchall()
+            if not rows:
+                return
+
+            await self._commit(rows)
+
+    async def _commit(self, rows: list[tuple]):
+        batch = self._db.batch()
+        for _, op, path, data, merge in rows:
+            reference = self._db.document(path)
+            if op == "set":
+                batch.set(reference, decode(json.loads(data)), merge=bool(merge))
+            elif op == "update":
+                batch.update(reference, decode(json.loads(data)))
+            else:
+                batch.delete(reference)
+
+        rejected = None
+        try:
+            await batch.commit()
+        except Exception as e:
+            if not is_permanent(e):
+                raise
+
+            rejected = e
+
+        if rejected is not None:
+            if len(rows) > 1:
+                # batches are atomic, halve it until the writes at fault are alone
+                middle = len(rows) // 2
+                await self._commit(rows[:middle])
+                await self._commit(rows[middle:])
+                return
+
+            print(f"[~] Outbox: dropped {rows[0][1]} of {rows[0][2]}:", file=sys.stderr)
+            traceback.print_exception(rejected)
+
+        self._conn.executemany("DELETE FROM writes WHERE id = ?", [(row[0],) for row in rows])
+        self._conn.commit()
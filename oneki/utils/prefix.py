@@ -0,0 +1,32 @@
+from typing import Iterable, Optional
+
+
+class PrefixMatcher:
+    """Immutable set of command prefixes indexed by their first character
+
+    Each bucket is sorted longest-first so the first match is the most
+    specific one, ``"??"`` wins over ``"?"``.
+    """
+    __slots__ = ("prefixes", "_buckets")
+
+    def __init__(self, prefixes: Iterable[str]) -> None:
+        self.prefixes: tuple[str, ...] = tuple(sorted({p for p in prefixes if p}, key=len, reverse=True))
+        
+        buckets: dict[str, list[str]] = {}
+        for prefix in self.prefixes:
+            buckets.setdefault(prefix[0], []).append(prefix)
+
+        self._buckets: dict[str, tuple[str, ...]] = {c: tuple(bucket) for c, bucket in buckets.items()}
+
+    def __repr__(self) -> str:
+        return f"<PrefixMatcher prefixes={self.prefixes!r}>"
+
+    def match(self, content: str) -> Optional[str]:
+        # CPython caches single latin-1 characters, so most misses allocate nothing
+        bucket = self._buckets.get(content[:1])
+        if bucket is None:
+            return None
+
+        for prefix in bucket:
+            if content.startswith(prefix):
+                return prefix
@@ -0,0 +1,214 @@
+from typing import Any, Awaitable, Callable, Optional, TYPE_CHECKING
+
+import asyncio
+import datetime
+import heapq
+import sys
+import time
+import traceback
+
+if TYPE_CHECKING:
+    from .db import AsyncClient
+    from .outbox import Outbox
+
+
+COLLECTION = "scheduled_jobs"
+# due jobs run concurrently per batch
+BATCH_SIZE = 100
+# seconds before a failed job runs again, and runs before it is dropped
+RETRY_DELAY = 60.0
+MAX_ATTEMPTS = 3
+# seconds of jobs read ahead from firestore, the later ones are read when they get closer
+WINDOW = 3600.0
+# seconds before trying again a pass that raised
+ERROR_DELAY = 10.0
+
+
+class Job:
+    __slots__ = ("id", "kind", "payload", "due", "attempts", "guild_id")
+
+    def __init__(self, id: str, kind: str, payload: Any, due: float, attempts: int = 0, guild_id: Optional[int] = None) -> None:
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.due = due
+        self.attempts = attempts
+        self.guild_id = guild_id
+
+    @classmethod
+    def from_doc(cls, doc) -> "Job":
+        data = doc.to_dict()
+        return cls(doc.id, data["kind"], data.get("payload"), data["due"].timestamp(), data.get("attempts", 0), data.get("guild"))
+
+    def to_dict(self) -> dict:
+        return {
+            "kind": self.kind,
+            "payload": self.payload,
+            "due": datetime.datetime.fromtimestamp(self.due, datetime.timezone.utc),
+            "attempts": self.attempts,
+            "guild": self.guild_id
+        }
+
+
+class Scheduler:
+    """Delayed jobs kept in firestore, they survive restarts and redeploys
+
+    A job is a kind, a payload and the time it is due, stored in
+    ``scheduled_jobs/{id}`` through the outbox. The jobs due within
+    :data:`WINDOW` seconds are read on start and every half window, and a
+    process only keeps the ones of the guilds it ``owns``, so a change of
+    sharding moves them with their guilds. A heap orders them by due time,
+    the entries of jobs finished or rescheduled meanwhile are dropped when
+    they reach the top. A task sleeps until the earliest job whose kind has a
+    handler, then runs the due ones in batches of :data:`BATCH_SIZE`. A failed
+    job is tried again :data:`RETRY_DELAY` seconds later, up to
+    :data:`MAX_ATTEMPTS` times.
+    """
+    def __init__(self, db: "AsyncClient", outbox: "Outbox", *, owns: Callable[[Optional[int]], bool] = lambda guild_id: True) -> None:
+        self._db = db
+        self._outbox = outbox
+        self.owns = owns
+        # kind: handler, called with the payload
+        self._handlers: dict[str, Callable[[Any], Awaitable]] = {}
+        # id: job due within the window
+        self._jobs: dict[str, Job] = {}
+        # (due, id) of the jobs above, the outdated entries are skipped
+        self._heap: list[tuple[float, str]] = []
+        # kind: jobs due before their handler was registered
+        self._unhandled: dict[str, list[Job]] = {}
+        # id: time it finished, its delete may still wait in the outbox when the window is read again
+        self._finished: dict[str, float] = {}
+        self._horizon = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def register(self, kind: str, handler: Callable[[Any], Awaitable]):
+        self._handlers[kind] = handler
+        for job in self._unhandled.pop(kind, ()):
+            self._push(job)
+
+        self._wakeup.set()
+
+    def unregister(self, kind: str):
+        self._handlers.pop(kind, None)
+
+    def schedule(self, delay: float, kind: str, payload: Any, *, guild_id: Optional[int] = None) -> str:
+        """Runs the handler of ``kind`` with ``payload`` in ``delay`` seconds, returns the job id
+
+        ``guild_id`` is the guild the job belongs to, it runs on the process
+        that owns it.
+        """
+        job = Job(self._db.collection(COLLECTION).document().id, kind, payload, time.time() + delay, guild_id=guild_id)
+        self._outbox.set(f"{COLLECTION}/{job.id}", job.to_dict())
+        if job.due <= self._horizon and self.owns(guild_id):
+            self._jobs[job.id] = job
+            self._push(job)
+            self._wakeup.set()
+
+        return job.id
+
+    def _push(self, job: Job):
+        heapq.heappush(self._heap, (job.due, job.id))
+
+    def _peek(self) -> Optional[Job]:
+        """Returns the earliest job with a handler, after dropping the entries before it"""
+        while self._heap:
+            due, job_id = self._heap[0]
+            job = self._jobs.get(job_id)
+            if job is None or job.due != due:
+                # finished or rescheduled
+                heapq.heappop(self._heap)
+            elif job.kind not in self._handlers:
+                heapq.heappop(self._heap)
+                self._unhandled.setdefault(job.kind, []).append(job)
+            else:
+                return job
+
+        return None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stops running jobs, the pending ones run on the next start"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+            self._task = None
+
+    async def _load(self, now: float):
+        horizon = now + WINDOW
+        until = datetime.datetime.fromtimestamp(horizon, datetime.timezone.utc)
+        query = self._db.collection(COLLECTION).where("due", "<=", until).order_by("due")
+        async for page in self._db.paginate(query):
+            for doc in page:
+                if doc.id in self._jobs or doc.id in self._finished:
+                    continue
+
+                job = Job.from_doc(doc)
+                if self.owns(job.guild_id):
+                    self._jobs[job.id] = job
+                    self._push(job)
+
+        self._horizon = horizon
+        self._finished = {job_id: at for job_id, at in self._finished.items() if at > now - WINDOW}
+
+    async def _run(self):
+        while True:
+            # cleared before reading, a job scheduled meanwhile sets it again
+            self._wakeup.clear()
+            try:
+                now = time.time()
+                if now >= self._horizon - WINDOW / 2:
+                    await self._load(now)
+
+                job = self._peek()
+                due = job.due if job is not None else self._horizon
+                if due <= now:
+                    await self._run_due(now)
+                    continue
+
+                # the window is read again half way, before the jobs beyond it are due
+                wake = min(due, self._horizon - WINDOW / 2)
+            except Exception:
+                # the loop outlives a failed pass, the jobs stay until one succeeds
+                print("[~] Scheduler: pass failed", file=sys.stderr)
+                traceback.print_exc()
+                wake = time.time() + ERROR_DELAY
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(wake - time.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_due(self, now: float):
+        jobs = []
+        while len(jobs) < BATCH_SIZE and (job := self._peek()) is not None and job.due <= now:
+            heapq.heappop(self._heap)
+            jobs.append(job)
+
+        results = await asyncio.gather(
+            *(self._handlers[job.kind](job.payload) for job in jobs),
+            return_exceptions=True
+        )
+
+        for job, result in zip(jobs, results):
+            if isinstance(result, BaseException):
+                print(f"[~] Scheduler: {job.kind} job {job.id} failed ({type(result).__name__}: {result})", file=sys.stderr)
+                if job.attempts + 1 < MAX_ATTEMPTS:
+                    job.attempts += 1
+                    job.due = now + RETRY_DELAY
+                    self._push(job)
+                    self._outbox.update(f"{COLLECTION}/{job.id}", {"due": job.to_dict()["due"], "attempts": job.attempts})
+                    continue
+
+            del self._jobs[job.id]
+            self._finished[job.id] = now
+            self._outbox.delete(f"{COLLECTION}/{job.id}")
@@ -0,0 +1,57 @@
+from typing import Awaitable, Callable, Hashable
+
+import asyncio
+import sys
+import traceback
+
+
+class SerialQueues:
+    """Bounded FIFO queues of jobs, one worker per key
+
+    The jobs of a key run one after the other in the order they were put,
+    jobs of different keys run concurrently. A worker exits once its queue is
+    empty, idle keys cost nothing.
+    """
+    def __init__(self, maxsize: int = 100) -> None:
+        self.maxsize = maxsize
+        self._queues: dict[Hashable, asyncio.Queue] = {}
+        self._workers: dict[Hashable, asyncio.Task] = {}
+
+    def __len__(self) -> int:
+        return len(self._queues)
+
+    def put(self, key: Hashable, job: Callable[[], Awaitable]) -> bool:
+        """Queues ``job`` after the pending jobs of ``key``, False if the queue is full"""
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = asyncio.Queue(self.maxsize)
+            self._workers[key] = asyncio.create_task(self._work(key, queue))
+
+        try:
+            queue.put_nowait(job)
+        except asyncio.QueueFull:
+            return False
+
+        return True
+
+    async def _work(self, key: Hashable, queue: asyncio.Queue):
+        try:
+            # nothing awaits between the last get and the cleanup, a put meanwhile is not lost
+            while not queue.empty():
+                job = queue.get_nowait()
+                try:
+                    await job()
+                except Exception:
+                    print(f"In queue {key}:", file=sys.stderr)
+                    traceback.print_exc()
+        finally:
+            self._queues.pop(key, None)
+            self._workers.pop(key, None)
+
+    def close(self):
+        """Cancels the workers, the jobs still queued are dropped"""
+        for worker in list(self._workers.values()):
+            worker.cancel()
+
+        self._queues.clear()
+        self._workers.clear()
@@ -0,0 +1,82 @@
+from typing import Any, Optional, TYPE_CHECKING
+
+import os
+import pickle
+
+from .db import version
+
+if TYPE_CHECKING:
+    from .db import AsyncClient
+
+
+SNAPSHOT_VERSION = 1
+DEFAULT_PATH = os.path.join(".cache", "state.pickle")
+# seconds between two snapshots while running
+INTERVAL = 600.0
+# documents checked per request on load
+CHECK_CHUNK_SIZE = 300
+
+
+class StateSnapshot:
+    """In-memory state of the bot persisted to local disk between restarts
+
+    The state is split in named sections, each one stores the revision of
+    every document it was read from (see :func:`db.version`). On load a
+    section is only reused if none of its documents changed since.
+    """
+    def __init__(self) -> None:
+        # name: {"state": Any, "versions": {path: revision}}
+        self.sections: dict[str, dict] = {}
+
+    def add(self, name: str, state: Any, versions: dict[str, Optional[str]]):
+        self.sections[name] = {"state": state, "versions": dict(versions)}
+
+    def dump(self, path: str = DEFAULT_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # write then rename, a crash never leaves a truncated snapshot behind
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump({"version": SNAPSHOT_VERSION, "sections": self.sections}, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_PATH) -> Optional["StateSnapshot"]:
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"[~] Ignoring unreadable snapshot {path}: {e}")
+            return None
+
+        if not isinstance(data, dict) or data.get("version") != SNAPSHOT_VERSION:
+            print(f"[~] Ignoring snapshot {path} written by another version")
+            return None
+
+        snapshot = cls()
+        snapshot.sections = data["sections"]
+        return snapshot
+
+    async def validate(self, db: "AsyncClient") -> dict[str, tuple[Any, dict[str, Optional[str]]]]:
+        """Returns the ``(state, versions)`` of the sections whose documents did not change
+
+        Only the revisions are fetched, an empty field mask leaves the
+        document data out of the responses.
+        """
+        paths = sorted({path for section in self.sections.values() for path in section["versions"]})
+        current = {}
+        for i in range(0, len(paths), CHECK_CHUNK_SIZE):
+            refs = [db.document(path) for path in paths[i:i + CHECK_CHUNK_SIZE]]
+            async for doc in db.get_all(refs, field_paths=[]):
+                current[doc.reference.path] = version(doc)
+
+        return {
+            name: (section["state"], section["versions"])
+            for name, section in self.sections.items()
+            if all(current.get(path) == revision for path, revision in section["versions"].items())
+        }
@@ -0,0 +1,32 @@
+from contextlib import contextmanager
+from typing import Iterator
+
+import time
+
+
+class Timeline:
+    """Records when each step of the startup ran and how long it took"""
+    def __init__(self) -> None:
+        self.origin = time.perf_counter()
+        # name, start, end
+        self.steps: list[tuple[str, float, float]] = []
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, start, time.perf_counter()))
+
+    def report(self) -> str:
+        lines = [f"{'start':>9} {'duration':>10}  step"]
+        for name, start, end in sorted(self.steps, key=lambda step: step[1]):
+            lines.append(f"{start - self.origin:>8.3f}s {(end - start) * 1000:>8.1f}ms  {name}")
+
+        lines.append(f"{time.perf_counter() - self.origin:>8.3f}s {'':>10}  total")
+        return "\n".join(lines)
+
+
+# the startup of this process, its origin is the first import of this module
+timeline = Timeline()
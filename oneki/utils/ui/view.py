@@ -37,6 +37,9 @@ class View(dexui.View):
         return await super().start(origin, **kwargs)
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if interaction.client.blacklist.is_blacklisted(interaction.user.id, interaction.guild_id):
+            return False
+        
         if self.user_check:
             check = interaction.user == self.author
             if not check:
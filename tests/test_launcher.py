@@ -0,0 +1,67 @@
+"""Sharded launch as Heroku runs it, ``python oneki`` with SHARD_COUNT set.
+
+The worker is spawned with a token discord rejects, so it has to get as far
+as ``run_worker`` and then exit, the launcher reports it and restarts it.
+
+    $ python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+TIMEOUT = 60.0
+
+
+def bot_importable() -> bool:
+    result = subprocess.run(
+        [sys.executable, "-c", "import bot"],
+        cwd=os.path.join(ROOT, "oneki"),
+        capture_output=True
+    )
+    return result.returncode == 0
+
+
+@pytest.mark.skipif(not bot_importable(), reason="the bot requirements are not installed")
+def test_spawned_worker_runs(tmp_path):
+    env = {
+        **os.environ,
+        "SHARD_COUNT": "1",
+        "DISCORD_TOKEN": "invalid",
+        "DISCORD_DEV_TOKEN": "",
+        "FIRESTORE_BACKEND": "memory",
+        "IPC_PORT": "7659",
+        "SNAPSHOT_PATH": str(tmp_path / "state.pickle"),
+        "OUTBOX_PATH": str(tmp_path / "outbox.sqlite3"),
+        "PYTHONUNBUFFERED": "1",
+    }
+    process = subprocess.Popen(
+        [sys.executable, "oneki"],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True
+    )
+
+    lines = []
+    deadline = time.monotonic() + TIMEOUT
+    try:
+        for line in process.stdout:
+            lines.append(line)
+            if "Worker 0 exited" in line or time.monotonic() > deadline:
+                break
+    finally:
+        process.kill()
+        process.wait()
+
+    output = "".join(lines)
+    assert "Worker 0 started with shards [0]" in output, output
+    assert "Can't get attribute" not in output, output
+    # the worker failed inside the bot, after it was unpickled and started
+    assert "in run_worker" in output, output
+    assert "Worker 0 exited" in output, output